@@ -1,2 +1,3 @@
 import runbot
 import res_config
+import cli
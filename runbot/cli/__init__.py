@@ -0,0 +1,6 @@
+# The commands of the cli package are found by openerp-server when the addons
+# path is its first argument:
+#   openerp-server --addons-path=<addons> runbotworker -d <database>
+#   openerp-server --addons-path=<addons> runbotsupervisor --socket <path>
+import worker
+import supervisor
@@ -0,0 +1,33 @@
+# -*- encoding: utf-8 -*-
+
+import argparse
+import signal
+
+import openerp
+from openerp.cli import Command
+
+from openerp.addons.runbot.supervisor import Supervisor, supervisor_path
+
+#----------------------------------------------------------
+# Runbot supervisor
+#----------------------------------------------------------
+
+class RunbotSupervisor(Command):
+    """Spawn the runbot jobs of this host and report their exit and resource usage
+
+    openerp-server --addons-path=<addons> runbotsupervisor --socket <path>
+    """
+
+    def run(self, args):
+        parser = argparse.ArgumentParser(prog='runbotsupervisor', description=self.__doc__,
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument('--socket', help="unix socket to listen on (default: runbot_supervisor option)")
+        opts, remaining = parser.parse_known_args(args)
+
+        openerp.tools.config.parse_config(remaining)
+        path = opts.socket or supervisor_path()
+        if not path:
+            parser.error("no socket given, use --socket or the runbot_supervisor option")
+        # jobs are killed with their process group, do not die with them
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        Supervisor(path).serve()
@@ -0,0 +1,68 @@
+# -*- encoding: utf-8 -*-
+
+import argparse
+import logging
+import time
+
+import openerp
+from openerp.cli import Command
+from openerp.modules.registry import RegistryManager
+
+from openerp.addons.runbot.worker import ChildWatcher
+
+_logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------
+# Runbot worker
+#----------------------------------------------------------
+
+class RunbotWorker(Command):
+    """Run the runbot cron of this host, several hosts can share a database
+
+    openerp-server --addons-path=<addons> runbotworker -d <database>
+    """
+
+    def run(self, args):
+        parser = argparse.ArgumentParser(prog='runbotworker', description=self.__doc__,
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument('-d', '--database', required=True, help="runbot database")
+        parser.add_argument('--host', help="name of this host (default: runbot_host option or hostname)")
+        parser.add_argument('--workers', type=int, help="number of builds tested at once on this host (default: runbot.workers)")
+        parser.add_argument('--interval', type=int, default=60, help="seconds between two fetches of the repositories (default: 60)")
+        parser.add_argument('--supervisor', help="socket of the runbot supervisor spawning the jobs (default: runbot_supervisor option)")
+        parser.add_argument('--tick', type=int, default=10, help="seconds between two schedulings when jobs run under a supervisor (default: 10)")
+        opts, remaining = parser.parse_known_args(args)
+
+        openerp.tools.config.parse_config(remaining)
+        if opts.host:
+            openerp.tools.config['runbot_host'] = opts.host
+        if opts.supervisor:
+            openerp.tools.config['runbot_supervisor'] = opts.supervisor
+
+        registry = RegistryManager.get(opts.database)
+        watcher = ChildWatcher()
+        next_cron = 0
+        while True:
+            # fetch and schedule every interval, only schedule as soon as a job exits
+            full = time.time() >= next_cron
+            try:
+                with openerp.api.Environment.manage():
+                    with registry.cursor() as cr:
+                        if full:
+                            registry['runbot.repo'].cron(cr, openerp.SUPERUSER_ID, workers=opts.workers)
+                            # the build directories of this host
+                            registry['runbot.trash'].empty(cr, openerp.SUPERUSER_ID)
+                        else:
+                            registry['runbot.repo'].cron_jobs(cr, openerp.SUPERUSER_ID, workers=opts.workers)
+            except Exception:
+                _logger.exception('runbot worker run failed')
+            if full:
+                next_cron = time.time() + opts.interval
+            timeout = next_cron - time.time()
+            if openerp.tools.config.get('runbot_supervisor'):
+                # the jobs are not our children, no SIGCHLD wakes us up
+                timeout = min(timeout, opts.tick)
+            if watcher.wait(timeout):
+                _logger.debug('runbot worker: job exited')
+                # coalesce the exits of jobs finishing together
+                time.sleep(1)
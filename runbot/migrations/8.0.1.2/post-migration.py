@@ -0,0 +1,20 @@
+# -*- encoding: utf-8 -*-
+
+import logging
+
+from openerp.addons.runbot.runbot import host_name
+
+logger = logging.getLogger('upgrade')
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    # builds started before several hosts could share the database ran on
+    # the host upgrading it, give them to that host so that the others do
+    # not schedule them too
+    cr.execute("UPDATE runbot_build SET host = %s "
+               "WHERE host IS NULL AND state NOT IN ('pending', 'done')",
+               (host_name(),))
+    logger.info("runbot_build: %s builds given to host %s",
+                cr.rowcount, host_name())
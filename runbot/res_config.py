@@ -30,6 +30,20 @@ class runbot_config_settings(osv.osv_memory):
         'default_timeout': fields.integer('Default Timeout (in seconds)'),
         'default_starting_port': fields.integer('Starting Port for Running Builds'),
         'default_domain': fields.char('Runbot Domain'),
+        'default_fetch_workers': fields.integer('Number of Repositories Fetched Concurrently'),
+        'default_hook_poll_interval': fields.integer('Polling Interval of Repositories with Webhooks (in seconds)'),
+        'default_cache_size': fields.integer('Size of the Source Cache (in MB)'),
+        'default_status_workers': fields.integer('Number of Github Statuses Sent Concurrently'),
+        'default_max_load': fields.float('Maximum Load per CPU to Start a Build (0 to disable)'),
+        'default_min_free_memory': fields.integer('Memory Kept Free When Starting a Build (in MB, 0 to disable)'),
+        'default_cgroup_root': fields.char('Cgroup (v2) Directory of the Jobs'),
+        'default_job_cpu': fields.float('CPUs per Job (0 for no limit)'),
+        'default_job_memory': fields.integer('Memory per Job (in MB, 0 for no limit)'),
+        'default_force_priority': fields.integer('Priority of Forced Builds'),
+        'default_sticky_priority': fields.integer('Priority Bonus of Sticky Branches'),
+        'default_aging': fields.integer('Queue Time Adding One Point of Priority (in seconds)'),
+        'default_template_count': fields.integer('Number of Template Databases Kept'),
+        'default_teardown_workers': fields.integer('Number of Build Directories Removed Concurrently'),
     }
 
     def get_default_parameters(self, cr, uid, fields, context=None):
@@ -39,12 +53,40 @@ class runbot_config_settings(osv.osv_memory):
         timeout = icp.get_param(cr, uid, 'runbot.timeout', default=1800)
         starting_port = icp.get_param(cr, uid, 'runbot.starting_port', default=2000)
         runbot_domain = icp.get_param(cr, uid, 'runbot.domain', default='runbot.odoo.com')
+        fetch_workers = icp.get_param(cr, uid, 'runbot.fetch_workers', default=4)
+        hook_poll_interval = icp.get_param(cr, uid, 'runbot.hook_poll_interval', default=3600)
+        cache_size = icp.get_param(cr, uid, 'runbot.cache_size', default=20480)
+        status_workers = icp.get_param(cr, uid, 'runbot.status_workers', default=4)
+        max_load = icp.get_param(cr, uid, 'runbot.max_load', default=1.5)
+        min_free_memory = icp.get_param(cr, uid, 'runbot.min_free_memory', default=1024)
+        cgroup_root = icp.get_param(cr, uid, 'runbot.cgroup_root', default='')
+        job_cpu = icp.get_param(cr, uid, 'runbot.job_cpu', default=0)
+        job_memory = icp.get_param(cr, uid, 'runbot.job_memory', default=0)
+        force_priority = icp.get_param(cr, uid, 'runbot.force_priority', default=100)
+        sticky_priority = icp.get_param(cr, uid, 'runbot.sticky_priority', default=10)
+        aging = icp.get_param(cr, uid, 'runbot.aging', default=3600)
+        template_count = icp.get_param(cr, uid, 'runbot.template_count', default=10)
+        teardown_workers = icp.get_param(cr, uid, 'runbot.teardown_workers', default=4)
         return {
         	'default_workers': int(workers),
         	'default_running_max': int(running_max),
             'default_timeout': int(timeout),
             'default_starting_port': int(starting_port),
             'default_domain': runbot_domain,
+            'default_fetch_workers': int(fetch_workers),
+            'default_hook_poll_interval': int(hook_poll_interval),
+            'default_cache_size': int(cache_size),
+            'default_status_workers': int(status_workers),
+            'default_max_load': float(max_load),
+            'default_min_free_memory': int(min_free_memory),
+            'default_cgroup_root': cgroup_root,
+            'default_job_cpu': float(job_cpu),
+            'default_job_memory': int(job_memory),
+            'default_force_priority': int(force_priority),
+            'default_sticky_priority': int(sticky_priority),
+            'default_aging': int(aging),
+            'default_template_count': int(template_count),
+            'default_teardown_workers': int(teardown_workers),
         }
 
     def set_default_parameters(self, cr, uid, ids, context=None):
@@ -55,6 +97,20 @@ class runbot_config_settings(osv.osv_memory):
         icp.set_param(cr, uid, 'runbot.timeout', config.default_timeout)
         icp.set_param(cr, uid, 'runbot.starting_port', config.default_starting_port)
         icp.set_param(cr, uid, 'runbot.domain', config.default_domain)
+        icp.set_param(cr, uid, 'runbot.fetch_workers', config.default_fetch_workers)
+        icp.set_param(cr, uid, 'runbot.hook_poll_interval', config.default_hook_poll_interval)
+        icp.set_param(cr, uid, 'runbot.cache_size', config.default_cache_size)
+        icp.set_param(cr, uid, 'runbot.status_workers', config.default_status_workers)
+        icp.set_param(cr, uid, 'runbot.max_load', config.default_max_load)
+        icp.set_param(cr, uid, 'runbot.min_free_memory', config.default_min_free_memory)
+        icp.set_param(cr, uid, 'runbot.cgroup_root', config.default_cgroup_root or '')
+        icp.set_param(cr, uid, 'runbot.job_cpu', config.default_job_cpu)
+        icp.set_param(cr, uid, 'runbot.job_memory', config.default_job_memory)
+        icp.set_param(cr, uid, 'runbot.force_priority', config.default_force_priority)
+        icp.set_param(cr, uid, 'runbot.sticky_priority', config.default_sticky_priority)
+        icp.set_param(cr, uid, 'runbot.aging', config.default_aging)
+        icp.set_param(cr, uid, 'runbot.template_count', config.default_template_count)
+        icp.set_param(cr, uid, 'runbot.teardown_workers', config.default_teardown_workers)
 
 
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
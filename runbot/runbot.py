@@ -1,36 +1,49 @@
 # -*- encoding: utf-8 -*-
 
+import ast
 import datetime
 import fcntl
 import glob
 import hashlib
+import hmac
 import logging
 import operator
 import os
+import pipes
 import re
-import resource
 import shutil
 import signal
 import simplejson
+import socket
 import subprocess
+import tempfile
+import threading
 import time
 import sys
 from collections import OrderedDict
+from contextlib import closing, contextmanager
+from cStringIO import StringIO
 import itertools
+from multiprocessing.pool import ThreadPool
 
 import dateutil.parser
+import psycopg2
 import requests
+import requests.adapters
 from matplotlib.font_manager import FontProperties
 from matplotlib.textpath import TextToPath
 import werkzeug
 
 import openerp
+import openerp.service.wsgi_server
 from openerp import http
 from openerp.http import request
 from openerp.osv import fields, osv
 from openerp.addons.website.models.website import slug
 from openerp.addons.website_sale.controllers.main import QueryURL
 
+from supervisor import exit_info, spawn_job, supervisor_path, supervisor_request
+
 _logger = logging.getLogger(__name__)
 
 #----------------------------------------------------------
@@ -64,6 +77,49 @@ _re_error = r'^(?:\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ (?:ERROR|CRITICAL) )|
 _re_warning = r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ WARNING '
 _re_job = re.compile('job_\d')
 
+# build counters updated by scan_log
+_log_patterns = [
+    ('log_errors', re.compile(_re_error, re.M)),
+    ('log_warnings', re.compile(_re_warning, re.M)),
+    ('log_tests', re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ INFO \S+ (?:openerp|odoo)\.modules\.module: (?:running \S+ tests|\S+ running tests)\.$', re.M)),
+    ('log_loaded', re.compile(r'\.modules\.loading: Modules loaded\.')),
+    ('log_shutdown', re.compile(r'Initiating shutdown\.')),
+]
+_re_error_search = re.compile(_re_error, re.M)
+_log_reset = dict([(name, 0) for name, regexp in _log_patterns], log_offset=0, result='')
+
+def scan_log(filename, offset, chunk_size=1 << 20, excerpt_lines=20):
+    """Count the matches of _log_patterns in the complete lines written in
+    filename after offset, return the offset following the last line counted,
+    the counts and an excerpt of the log from the first error found"""
+    counts = dict((name, 0) for name, regexp in _log_patterns)
+    excerpt = None
+    if not os.path.isfile(filename):
+        return offset, counts, excerpt
+    with open(filename) as f:
+        f.seek(offset)
+        # the start of a line longer than a chunk, or of the last line which
+        # is still being written
+        partial = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = partial + chunk
+            end = data.rfind('\n')
+            if end == -1:
+                partial = data
+                continue
+            partial = data[end + 1:]
+            data = data[:end + 1]
+            for name, regexp in _log_patterns:
+                counts[name] += len(regexp.findall(data))
+            if excerpt is None and counts['log_errors']:
+                start = data.rfind('\n', 0, _re_error_search.search(data).start()) + 1
+                excerpt = '\n'.join(data[start:].splitlines()[:excerpt_lines])
+            offset += len(data)
+    return offset, counts, excerpt
+
 def rfind(filename, pattern):
     """Determine in something in filename matches the pattern"""
     if os.path.isfile(filename):
@@ -73,10 +129,6 @@ def rfind(filename, pattern):
                 return True
     return False
 
-def lock(filename):
-    fd = os.open(filename, os.O_CREAT | os.O_RDWR, 0600)
-    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-
 def locked(filename):
     result = False
     try:
@@ -111,6 +163,244 @@ def run(l, env=None):
     log("run", rc=rc)
     return rc
 
+def git(path, cmd):
+    """Execute git command cmd on the bare repository at path"""
+    cmd = ['git', '--git-dir=%s' % path] + cmd
+    _logger.info("git: %s", ' '.join(cmd))
+    return subprocess.check_output(cmd)
+
+def remote_has_ref(path, remote, ref):
+    """Tell whether the ref exists on remote, raise when remote cannot be
+    listed (network, authentication, ...)"""
+    return bool(git(path, ['ls-remote', remote, ref]).strip())
+
+def fetch_refs(name, path, snapshot, refnames=None, store=None):
+    """Fetch the repository name into path and diff its refs against snapshot
+
+    Does not use the database so that it can run in a worker thread. Returns
+    a dict with the ``current`` refs (name -> sha), the ``changed`` and
+    ``deleted`` ref names and the detailed ``refs`` (name, sha, date, author,
+    subject) of the changed ones. When ``refnames`` is given only those refs
+    (``refs/heads/<branch>`` or ``refs/pull/<number>``) are fetched and
+    compared, ``full`` tells whether all refs were. When ``store`` is given,
+    objects are fetched in that shared bare repository and borrowed through
+    git alternates.
+    """
+    start = time.time()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if not os.path.isdir(os.path.join(path, 'refs')):
+        if store:
+            git(path, ['init', '--bare'])
+            git(path, ['remote', 'add', 'origin', name])
+        else:
+            run(['git', 'clone', '--bare', name, path])
+        refnames = None
+
+    # refspecs as (remote ref, local ref)
+    if refnames:
+        refspecs = [(ref + '/head' if ref.startswith('refs/pull/') else ref, ref) for ref in refnames]
+    else:
+        refspecs = [('refs/heads/*', 'refs/heads/*'), ('refs/pull/*/head', 'refs/pull/*')]
+
+    if store:
+        # fetch the objects once in the store, under a namespace of the repository
+        init_store(store)
+        alternates = os.path.join(path, 'objects', 'info', 'alternates')
+        if not os.path.isfile(alternates):
+            mkdirs([os.path.dirname(alternates)])
+            with open(alternates, 'w') as f:
+                f.write(os.path.join(store, 'objects') + '\n')
+        namespace = 'refs/namespaces/%s/' % os.path.basename(path)
+        source = store
+        # concurrent fetches would fail to lock the packed refs of the store
+        with store_lock(store):
+            for remote, local in refspecs:
+                try:
+                    git(store, ['fetch'] + ([] if refnames else ['-p']) + [name, '+%s:%s%s' % (remote, namespace, local)])
+                except subprocess.CalledProcessError:
+                    if not refnames or remote_has_ref(store, name, remote):
+                        raise
+                    # the ref is gone upstream
+                    git(store, ['update-ref', '-d', namespace + local])
+        refspecs = [(namespace + local, local) for remote, local in refspecs]
+    else:
+        source = 'origin'
+    for remote, local in refspecs:
+        try:
+            git(path, ['fetch'] + ([] if refnames else ['-p']) + [source, '+%s:%s' % (remote, local)])
+        except subprocess.CalledProcessError:
+            if not refnames or remote_has_ref(path, source, remote):
+                raise
+            # the ref is gone upstream, or from the store where it was deleted
+            git(path, ['update-ref', '-d', local])
+    fetch_time = time.time() - start
+
+    # diff the refs of the repository against the last snapshot
+    patterns = sorted(refnames) if refnames else ['refs/heads', 'refs/pull']
+    git_refs = git(path, ['for-each-ref', '--format', '%(refname)%00%(objectname)'] + patterns)
+    listed = dict(
+        [decode_utf(field) for field in line.split('\x00')]
+        for line in git_refs.splitlines() if line
+    )
+    if refnames:
+        listed = dict((ref, sha) for ref, sha in listed.iteritems() if ref in refnames)
+        deleted = set(ref for ref in refnames if ref in snapshot and ref not in listed)
+        current = dict((ref, sha) for ref, sha in snapshot.iteritems() if ref not in deleted)
+        current.update(listed)
+    else:
+        deleted = set(snapshot) - set(listed)
+        current = listed
+    changed = set(ref for ref, sha in listed.iteritems() if snapshot.get(ref) != sha)
+
+    refs = []
+    if changed:
+        fields = ['refname','objectname','committerdate:iso8601','authorname','subject']
+        fmt = "%00".join(["%("+field+")" for field in fields])
+        cmd = ['for-each-ref', '--format', fmt, '--sort=-committerdate']
+        # for-each-ref patterns also match refs below them, results are filtered afterwards
+        cmd += sorted(changed) if len(changed) <= 100 else ['refs/heads', 'refs/pull']
+        git_refs = git(path, cmd)
+        refs = [[decode_utf(field) for field in line.split('\x00')] for line in git_refs.splitlines() if line]
+        refs = [ref for ref in refs if ref[0] in changed]
+
+    _logger.info('repo %s fetched in %.2fs, listed in %.2fs: %s changed, %s deleted refs',
+                 name, fetch_time, time.time() - start - fetch_time, len(changed), len(deleted))
+    return {
+        'full': not refnames,
+        'current': current,
+        'changed': changed,
+        'deleted': deleted,
+        'refs': refs,
+    }
+
+@contextmanager
+def store_lock(store):
+    """Hold the lock of the shared object store, serializing the processes
+    and threads updating it"""
+    fd = os.open(store + '.lock', os.O_CREAT | os.O_RDWR, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+def init_store(store):
+    """Create the shared object store if needed"""
+    if os.path.isdir(os.path.join(store, 'refs')):
+        return
+    mkdirs([store])
+    with store_lock(store):
+        if not os.path.isdir(os.path.join(store, 'refs')):
+            git(store, ['init', '--bare'])
+
+def commit_dates(path, shas):
+    """Return the committer timestamps of the commits, read by one git process"""
+    p = subprocess.Popen(['git', '--git-dir=%s' % path, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = p.communicate(''.join('%s\n' % sha for sha in shas))[0]
+    dates = {}
+    pos = 0
+    while pos < len(out):
+        end = out.index('\n', pos)
+        header = out[pos:end].split()
+        pos = end + 1
+        if len(header) != 3:
+            # missing object
+            continue
+        sha, kind, size = header[0], header[1], int(header[2])
+        content = out[pos:pos + size]
+        pos += size + 1
+        for line in content.split('\n'):
+            if not line:
+                break
+            if line.startswith('committer '):
+                dates[sha] = int(line.rsplit(' ', 2)[1])
+    return dates
+
+def safe_fetch_refs(args):
+    """fetch_refs for a thread pool, failures only affect their repository"""
+    try:
+        return fetch_refs(*args)
+    except Exception:
+        _logger.exception('repo %s fetch failed', args[0])
+        return None
+
+def host_name():
+    """Return the name of this runbot host"""
+    return openerp.tools.config.get('runbot_host') or socket.gethostname()
+
+def host_load():
+    """Return the 1 minute load average per cpu of this host"""
+    try:
+        cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+    except (ValueError, OSError):
+        cpus = 1
+    return os.getloadavg()[0] / max(cpus, 1)
+
+def host_memory():
+    """Return the memory available on this host in MB, None when unknown"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+    return None
+
+def port_free(port):
+    """Check that port can be bound on this host"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # as the servers do, ignore the connections in TIME_WAIT
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def pg_copydb(template, dbname):
+    """Create the database dbname as a copy of template"""
+    db = openerp.sql_db.db_connect('postgres')
+    with closing(db.cursor()) as cr:
+        cr.autocommit(True)
+        cr.execute('CREATE DATABASE "%s" TEMPLATE "%s"' % (dbname, template))
+
+def read_manifest(path):
+    try:
+        with open(path) as f:
+            return ast.literal_eval(f.read())
+    except (IOError, SyntaxError, ValueError):
+        return {}
+
+def module_depends(addons_path, modules):
+    """Return modules with all the modules they depend on"""
+    depends = set()
+    todo = list(modules)
+    while todo:
+        module = todo.pop()
+        if module in depends:
+            continue
+        depends.add(module)
+        manifest = read_manifest(os.path.join(addons_path, module, '__openerp__.py'))
+        todo.extend(manifest.get('depends', []))
+    return depends
+
+def module_shards(addons_path, modules, count):
+    """Split modules in at most count groups, each one is tested in its own
+    database once its dependencies are installed. A module goes to the group
+    whose dependencies grow the least, which balances the groups by number of
+    modules to install and keeps modules sharing dependencies together."""
+    depends = dict((module, module_depends(addons_path, [module])) for module in modules)
+    shards = [(set(), []) for i in range(count)]
+    for module in sorted(modules, key=lambda m: (-len(depends[m]), m)):
+        shard = min(shards, key=lambda s: len(s[0] | depends[module]))
+        shard[0].update(depends[module])
+        shard[1].append(module)
+    return [sorted(group) for installed, group in shards if group]
+
 def now():
     return time.strftime(openerp.tools.DEFAULT_SERVER_DATETIME_FORMAT)
 
@@ -137,6 +427,102 @@ def decode_utf(field):
 def uniq_list(l):
     return OrderedDict.fromkeys(l).keys()
 
+class GithubRateLimited(Exception):
+    pass
+
+class GithubClient(object):
+    """Keep-alive github API client
+
+    GET responses are cached with their ETag and revalidated with
+    If-None-Match, not modified responses do not count in the github rate
+    limit. Once the remaining quota goes below ``reserve``, GET requests are
+    refused until the quota is reset so that statuses can still be sent.
+    """
+    cache_size = 1000
+    reserve = 100
+
+    def __init__(self, token):
+        self.session = requests.Session()
+        self.session.auth = (token, 'x-oauth-basic')
+        self.session.headers.update({'Accept': 'application/vnd.github.she-hulk-preview+json'})
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.remaining = None
+        self.reset = 0
+        self.calls = 0
+        self.cached = 0
+        self.latency = 0.0
+
+    def request(self, method, url, payload=None):
+        return self._request(method, url, payload)[0]
+
+    def pages(self, url):
+        """Iterate over the items of all the pages of a listing"""
+        while url:
+            result, links = self._request('GET', url)
+            for item in result or []:
+                yield item
+            url = links.get('next', {}).get('url')
+
+    def _request(self, method, url, payload=None):
+        """Return the decoded response and its pagination links"""
+        if self.remaining is not None and time.time() < self.reset:
+            if self.remaining <= 0 or (method == 'GET' and self.remaining < self.reserve):
+                raise GithubRateLimited('github rate limit reached (%s remaining), reset in %ss' % (self.remaining, int(self.reset - time.time())))
+        headers = {}
+        with self.lock:
+            cached = self.cache.get(url) if method == 'GET' else None
+        if cached:
+            headers['If-None-Match'] = cached[0]
+
+        start = time.time()
+        data = simplejson.dumps(payload) if payload is not None else None
+        response = self.session.request(method, url, data=data, headers=headers)
+        elapsed = time.time() - start
+
+        with self.lock:
+            self.calls += 1
+            self.latency += elapsed
+            if 'X-RateLimit-Remaining' in response.headers:
+                self.remaining = int(response.headers['X-RateLimit-Remaining'])
+                self.reset = int(response.headers.get('X-RateLimit-Reset', 0))
+            if response.status_code == 304 and cached:
+                self.cached += 1
+                self.cache[url] = self.cache.pop(url, cached)
+                return cached[1], cached[2]
+        _logger.debug('github %s %s: %s in %.3fs', method, url, response.status_code, elapsed)
+        response.raise_for_status()
+        result = response.json() if response.content else None
+        if method == 'GET' and response.headers.get('ETag'):
+            with self.lock:
+                self.cache.pop(url, None)
+                self.cache[url] = (response.headers['ETag'], result, response.links)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result, response.links
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'cached': self.cached,
+                'latency': self.latency / self.calls if self.calls else 0.0,
+                'remaining': self.remaining,
+            }
+
+_github_clients = {}
+_github_clients_lock = threading.Lock()
+
+def github_client(key, token):
+    """Return the github client of key (a repository), shared by the threads of the process"""
+    with _github_clients_lock:
+        client = _github_clients.get(key)
+        if client is None or client.session.auth[0] != token:
+            client = _github_clients[key] = GithubClient(token)
+        return client
+
 #----------------------------------------------------------
 # RunBot Models
 #----------------------------------------------------------
@@ -163,12 +549,26 @@ class runbot_repo(osv.osv):
             result[repo.id] = name
         return result
 
+    def _get_github_stats(self, cr, uid, ids, field_name, arg, context=None):
+        result = {}
+        for repo in self.browse(cr, uid, ids, context=context):
+            stats = github_client(repo.id, repo.token).stats() if repo.token else {}
+            result[repo.id] = {
+                'github_calls': stats.get('calls', 0),
+                'github_cached': stats.get('cached', 0),
+                'github_latency': stats.get('latency', 0.0),
+                'github_remaining': stats.get('remaining') or 0,
+            }
+        return result
+
     _columns = {
         'name': fields.char('Repository', required=True),
         'path': fields.function(_get_path, type='char', string='Directory', readonly=1),
         'base': fields.function(_get_base, type='char', string='Base URL', readonly=1),
         'testing': fields.integer('Concurrent Testing'),
         'running': fields.integer('Concurrent Running'),
+        'weight': fields.float('Weight', help="Share of the workers given to this repository relative to the others."),
+        'quota': fields.integer('Quota', help="Maximum number of builds of this repository tested at once on all hosts, 0 for no limit."),
         'jobs': fields.char('Jobs'),
         'nginx': fields.boolean('Nginx'),
         'auto': fields.boolean('Auto'),
@@ -180,10 +580,24 @@ class runbot_repo(osv.osv):
             string='Extra dependencies',
             help="Community addon repos which need to be present to run tests."),
         'token': fields.char("Github token"),
+        'fail_fast': fields.boolean('Fail fast', help="Stop the tests of a build on their first error, the branches can override it."),
+        'incremental': fields.boolean('Incremental', help="Only test the modules changed by non-sticky branches and the modules depending on them."),
+        'test_shards': fields.integer('Test shards', help="Split the modules tested by job_20_test_all into this number of groups tested in parallel, each in its own database."),
+        'ref_snapshot': fields.text('Refs snapshot', readonly=True, help="JSON mapping of ref names to sha at the last update."),
+        'fetch_time': fields.datetime('Last full fetch', readonly=True),
+        'hook_time': fields.datetime('Last webhook', readonly=True),
+        'hook_secret': fields.char('Webhook secret', help="Secret used to sign the github webhook payloads, checked when set."),
+        'github_calls': fields.function(_get_github_stats, type='integer', string='Github calls', multi='github'),
+        'github_cached': fields.function(_get_github_stats, type='integer', string='Github calls not modified', multi='github'),
+        'github_latency': fields.function(_get_github_stats, type='float', string='Github average latency (s)', multi='github'),
+        'github_remaining': fields.function(_get_github_stats, type='integer', string='Github rate limit remaining', multi='github'),
+        'shared_objects': fields.boolean('Shared object store', help="Fetch the objects in a bare repository shared with the other repositories using this option (forks, dependencies) and borrow them through git alternates."),
     }
     _defaults = {
         'testing': 1,
         'running': 1,
+        'weight': 1.0,
+        'quota': 0,
         'auto': True,
     }
 
@@ -199,93 +613,258 @@ class runbot_repo(osv.osv):
     def git(self, cr, uid, ids, cmd, context=None):
         """Execute git command cmd"""
         for repo in self.browse(cr, uid, ids, context=context):
-            cmd = ['git', '--git-dir=%s' % repo.path] + cmd
-            _logger.info("git: %s", ' '.join(cmd))
-            return subprocess.check_output(cmd)
+            return git(repo.path, cmd)
 
     def git_export(self, cr, uid, ids, treeish, dest, context=None):
+        """Export treeish into dest through the source cache, return its tree sha
+
+        Trees are extracted once in root/cache/<tree sha> and hardlinked into
+        the destination, builds must not modify their sources in place.
+        """
         for repo in self.browse(cr, uid, ids, context=context):
             _logger.debug('checkout %s %s %s', repo.name, treeish, dest)
-            p1 = subprocess.Popen(['git', '--git-dir=%s' % repo.path, 'archive', treeish], stdout=subprocess.PIPE)
-            p2 = subprocess.Popen(['tar', '-xC', dest], stdin=p1.stdout, stdout=subprocess.PIPE)
-            p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
-            p2.communicate()[0]
+            try:
+                tree = repo.git(['rev-parse', '%s^{tree}' % treeish]).strip()
+            except subprocess.CalledProcessError:
+                # the commit was found by another host, fetch it here
+                fetch_refs(*self.fetch_args(cr, uid, [repo.id], context=context)[0])
+                tree = repo.git(['rev-parse', '%s^{tree}' % treeish]).strip()
+            cache_dir = os.path.join(self.root(cr, uid), 'cache')
+            cache_path = os.path.join(cache_dir, tree)
+            extracted = False
+            if os.path.isdir(cache_path):
+                os.utime(cache_path, None)
+            else:
+                mkdirs([cache_dir])
+                tmp_path = tempfile.mkdtemp(prefix='tmp-', dir=cache_dir)
+                os.chmod(tmp_path, 0755)
+                p1 = subprocess.Popen(['git', '--git-dir=%s' % repo.path, 'archive', tree], stdout=subprocess.PIPE)
+                p2 = subprocess.Popen(['tar', '-xC', tmp_path], stdin=p1.stdout, stdout=subprocess.PIPE)
+                p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
+                p2.communicate()[0]
+                size = int(subprocess.check_output(['du', '-sk', tmp_path]).split()[0])
+                with open(cache_path + '.size', 'w') as f:
+                    f.write(str(size))
+                try:
+                    os.rename(tmp_path, cache_path)
+                except OSError:
+                    # extracted concurrently by another build
+                    shutil.rmtree(tmp_path, True)
+                extracted = True
+            mkdirs([dest])
+            subprocess.check_call(['cp', '-a', '--link', '--force', os.path.join(cache_path, '.'), dest])
+            if extracted:
+                # once linked, the tree may be evicted but not before
+                self.cache_gc(cr, uid, keep=[cache_path], context=context)
+            return tree
+
+    def cache_gc(self, cr, uid, keep=(), context=None):
+        """Evict the least recently used source trees above runbot.cache_size
+        (in MB), but the trees in keep"""
+        icp = self.pool['ir.config_parameter']
+        budget = int(icp.get_param(cr, uid, 'runbot.cache_size', default=20480)) * 1024
+        cache_dir = os.path.join(self.root(cr, uid), 'cache')
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name.startswith('tmp-') or not os.path.isdir(path):
+                continue
+            try:
+                size = int(open(path + '.size').read())
+            except (IOError, ValueError):
+                size = 0
+            entries.append((os.path.getmtime(path), size, path))
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= budget:
+                break
+            if path in keep:
+                continue
+            _logger.debug('source cache evicting %s', path)
+            shutil.rmtree(path, True)
+            if os.path.exists(path + '.size'):
+                os.remove(path + '.size')
+            total -= size
+
+    def github_url(self, cr, uid, repo, url, context=None):
+        """Return the absolute github API url of url for repo, or None"""
+        match_object = re.search('([^/]+)/([^/]+)/([^/.]+(.git)?)', repo.base)
+        if match_object:
+            url = url.replace(':owner', match_object.group(2))
+            url = url.replace(':repo', match_object.group(3))
+            icp = self.pool['ir.config_parameter']
+            api_url = icp.get_param(cr, uid, 'runbot.github_api_url') or 'https://api.%s' % match_object.group(1)
+            return api_url.rstrip('/') + url
 
     def github(self, cr, uid, ids, url, payload=None, delete=False, context=None):
         """Return a http request to be sent to github"""
         for repo in self.browse(cr, uid, ids, context=context):
             if not repo.token:
                 raise Exception('Repository does not have a token to authenticate')
-            match_object = re.search('([^/]+)/([^/]+)/([^/.]+(.git)?)', repo.base)
-            if match_object:
-                url = url.replace(':owner', match_object.group(2))
-                url = url.replace(':repo', match_object.group(3))
-                url = 'https://api.%s%s' % (match_object.group(1),url)
-                session = requests.Session()
-                session.auth = (repo.token,'x-oauth-basic')
-                session.headers.update({'Accept': 'application/vnd.github.she-hulk-preview+json'})
+            url = self.github_url(cr, uid, repo, url, context=context)
+            if url:
+                client = github_client(repo.id, repo.token)
                 if payload:
-                    response = session.post(url, data=simplejson.dumps(payload))
+                    return client.request('POST', url, payload)
                 elif delete:
-                    response = session.delete(url)
+                    return client.request('DELETE', url)
                 else:
-                    response = session.get(url)
-                return response.json()
+                    return client.request('GET', url)
+
+    def fetch_args(self, cr, uid, ids, refnames=None, context=None):
+        """Return the fetch_refs arguments of the repositories"""
+        store = os.path.join(self.root(cr, uid), 'repo', '.shared')
+        return [
+            (repo.name, repo.path, simplejson.loads(repo.ref_snapshot or '{}'), refnames, store if repo.shared_objects else None)
+            for repo in self.browse(cr, uid, ids, context=context)
+        ]
 
     def update(self, cr, uid, ids, context=None):
-        for repo in self.browse(cr, uid, ids, context=context):
-            self.update_git(cr, uid, repo)
+        icp = self.pool['ir.config_parameter']
+        fetch_workers = int(icp.get_param(cr, uid, 'runbot.fetch_workers', default=4))
+        repos = self.browse(cr, uid, ids, context=context)
+        if not repos:
+            return
+        # network and disk bound git work runs concurrently, without the ORM
+        args = self.fetch_args(cr, uid, ids, context=context)
+        pool = ThreadPool(max(1, min(fetch_workers, len(args))))
+        try:
+            results = pool.map(safe_fetch_refs, args)
+        finally:
+            pool.close()
+            pool.join()
+        # the reconciliation with the database is done serially, each
+        # repository in its own transaction: the snapshot of the cursor was
+        # taken before the fetch and other hosts reconcile the same rows
+        for repo, fetched in zip(repos, results):
+            if fetched is None:
+                continue
+            try:
+                self.update_fetched(cr, uid, repo, fetched, context=context)
+            except psycopg2.extensions.TransactionRollbackError:
+                # still conflicting, the next update fetches it again
+                _logger.warning('repo %s reconciliation conflicted with another host', repo.name)
 
     def update_git(self, cr, uid, repo, context=None):
-        _logger.debug('repo %s updating branches', repo.name)
-
+        fetched = fetch_refs(*self.fetch_args(cr, uid, [repo.id], context=context)[0])
+        self.update_fetched(cr, uid, repo, fetched, context=context)
+
+    def update_fetched(self, cr, uid, repo, fetched, values=None, context=None):
+        """Reconcile branches and builds with the result of fetch_refs, and
+        write values on the repository
+
+        The reconciliation commits the current transaction and starts a new
+        one with the lock of the repository, which serializes the concurrent
+        reconciliations (cron of the hosts, hooks). The cursors are
+        repeatable read, a reconciliation whose snapshot predates a
+        concurrent one fails to serialize and is retried.
+        """
+        values = dict(values or {})
+        if fetched['full']:
+            values['fetch_time'] = now()
+        if fetched['changed'] or fetched['deleted']:
+            values['ref_snapshot'] = simplejson.dumps(fetched['current'])
+        for attempt in range(1, 4):
+            cr.commit()
+            try:
+                start = time.time()
+                cr.execute("SELECT id FROM runbot_repo WHERE id = %s FOR UPDATE", (repo.id,))
+                self._reconcile(cr, uid, repo, fetched, context=context)
+                self.write(cr, uid, [repo.id], values, context=context)
+                cr.commit()
+                break
+            except psycopg2.extensions.TransactionRollbackError:
+                cr.rollback()
+                if attempt == 3:
+                    raise
+                _logger.debug('repo %s reconciliation conflicted, retrying', repo.name)
+        if fetched['changed'] or fetched['deleted']:
+            _logger.info('repo %s reconciled %s changed and %s deleted refs in %.2fs',
+                         repo.name, len(fetched['changed']), len(fetched['deleted']), time.time() - start)
+
+    def _reconcile(self, cr, uid, repo, fetched, context=None):
+        """Create the branches and builds of the changed refs, mark the
+        branches of the deleted refs"""
         Build = self.pool['runbot.build']
         Branch = self.pool['runbot.branch']
 
-        if not os.path.isdir(os.path.join(repo.path)):
-            os.makedirs(repo.path)
-        if not os.path.isdir(os.path.join(repo.path, 'refs')):
-            run(['git', 'clone', '--bare', repo.name, repo.path])
-        else:
-            repo.git(['fetch', '-p', 'origin', '+refs/heads/*:refs/heads/*'])
-            repo.git(['fetch', '-p', 'origin', '+refs/pull/*/head:refs/pull/*'])
+        if fetched['refs']:
+            self.update_refs(cr, uid, repo, fetched['refs'], context=context)
 
-        fields = ['refname','objectname','committerdate:iso8601','authorname','subject']
-        fmt = "%00".join(["%("+field+")" for field in fields])
-        git_refs = repo.git(['for-each-ref', '--format', fmt, '--sort=-committerdate', 'refs/heads', 'refs/pull'])
-        git_refs = git_refs.strip()
+        if fetched['deleted']:
+            # mark branches whose ref disappeared (e.g. closed pull requests)
+            deleted_ids = Branch.search(cr, uid, [('repo_id', '=', repo.id), ('name', 'in', list(fetched['deleted']))])
+            Branch.write(cr, uid, deleted_ids, {'state': 'deleted'}, context=context)
+            to_be_skipped_ids = Build.search(cr, uid, [('branch_id', 'in', deleted_ids), ('branch_id.sticky', '=', False), ('state', '=', 'pending')])
+            Build.skip(cr, uid, to_be_skipped_ids)
+
+    def update_hook(self, cr, uid, ids, refnames, context=None):
+        """Fetch and build the refs notified by a webhook"""
+        for repo in self.browse(cr, uid, ids, context=context):
+            _logger.debug('repo %s hook for %s', repo.name, ', '.join(refnames))
+            fetched = fetch_refs(*self.fetch_args(cr, uid, [repo.id], refnames, context=context)[0])
+            self.update_fetched(cr, uid, repo, fetched, {'hook_time': now()}, context=context)
 
-        refs = [[decode_utf(field) for field in line.split('\x00')] for line in git_refs.split('\n')]
+    def update_refs(self, cr, uid, repo, refs, context=None):
+        """Create the branches and builds for the given refs
 
+        ``refs`` is a list of (name, sha, date, author, subject) as returned by
+        ``git for-each-ref``, only the refs which changed since the last update
+        are expected.
+        """
+        Build = self.pool['runbot.build']
+        Branch = self.pool['runbot.branch']
+
+        # load branches and builds of the refs once, keyed by ref name and (branch, sha)
+        names = [ref[0] for ref in refs]
+        branches = dict(
+            (branch['name'], branch)
+            for branch in Branch.search_read(cr, uid, [('repo_id', '=', repo.id), ('name', 'in', names)], ['name', 'sticky', 'state'], context=context)
+        )
+        known_builds = set()
+        if branches:
+            branch_ids = tuple(branch['id'] for branch in branches.itervalues())
+            cr.execute("SELECT branch_id, name FROM runbot_build WHERE branch_id IN %s", (branch_ids,))
+            known_builds = set(cr.fetchall())
+
+        # a ref which comes back is no longer deleted
+        revived_ids = [branch['id'] for branch in branches.itervalues() if branch['state'] == 'deleted']
+        if revived_ids:
+            Branch.write(cr, uid, revived_ids, {'state': False}, context=context)
+
+        max_age = datetime.datetime.now() - datetime.timedelta(30)
+        new_builds = []
         for name, sha, date, author, subject in refs:
             # create or get branch
-            branch_ids = Branch.search(cr, uid, [('repo_id', '=', repo.id), ('name', '=', name)])
-            if branch_ids:
-                branch_id = branch_ids[0]
-            else:
+            branch = branches.get(name)
+            if branch is None:
                 _logger.debug('repo %s found new branch %s', repo.name, name)
                 branch_id = Branch.create(cr, uid, {'repo_id': repo.id, 'name': name})
-            branch = Branch.browse(cr, uid, [branch_id], context=context)[0]
+                branch = branches[name] = {'id': branch_id, 'name': name, 'sticky': False}
             # skip build for old branches
-            if dateutil.parser.parse(date[:19]) + datetime.timedelta(30) < datetime.datetime.now():
+            date = dateutil.parser.parse(date[:19])
+            if date < max_age:
                 continue
-            # create build (and mark previous builds as skipped) if not found
-            build_ids = Build.search(cr, uid, [('branch_id', '=', branch.id), ('name', '=', sha)])
-            if not build_ids:
-                if not branch.sticky:
-                    to_be_skipped_ids = Build.search(cr, uid, [('branch_id', '=', branch.id), ('state', '=', 'pending')])
-                    Build.skip(cr, uid, to_be_skipped_ids)
-
-                _logger.debug('repo %s branch %s new build found revno %s', branch.repo_id.name, branch.name, sha)
-                build_info = {
-                    'branch_id': branch.id,
+            # create build if not found
+            if (branch['id'], sha) not in known_builds:
+                _logger.debug('repo %s branch %s new build found revno %s', repo.name, name, sha)
+                new_builds.append((branch, {
+                    'branch_id': branch['id'],
                     'name': sha,
                     'author': author,
                     'subject': subject,
-                    'date': dateutil.parser.parse(date[:19]),
-                    'modules': branch.repo_id.modules,
-                }
-                Build.create(cr, uid, build_info)
+                    'date': date,
+                    'modules': repo.modules,
+                }))
+
+        # mark pending builds superseded by the new ones as skipped
+        superseded_branch_ids = list(set(branch['id'] for branch, _ in new_builds if not branch['sticky']))
+        if superseded_branch_ids:
+            to_be_skipped_ids = Build.search(cr, uid, [('branch_id', 'in', superseded_branch_ids), ('state', '=', 'pending')])
+            Build.skip(cr, uid, to_be_skipped_ids)
+
+        for branch, build_info in new_builds:
+            Build.create(cr, uid, build_info)
 
         # skip old builds (if their sequence number is too low, they will not ever be built)
         skippable_domain = [('repo_id', '=', repo.id), ('state', '=', 'pending')]
@@ -294,38 +873,41 @@ class runbot_repo(osv.osv):
         to_be_skipped_ids = Build.search(cr, uid, skippable_domain, order='sequence desc', offset=running_max)
         Build.skip(cr, uid, to_be_skipped_ids)
 
-    def scheduler(self, cr, uid, ids=None, context=None):
+    def scheduler(self, cr, uid, ids=None, workers=None, context=None):
+        """Schedule the builds of this host
+
+        Several hosts can share the database, each one runs the jobs of its own
+        builds and claims pending builds up to its number of workers.
+        """
         icp = self.pool['ir.config_parameter']
-        workers = int(icp.get_param(cr, uid, 'runbot.workers', default=6))
+        workers = workers or int(icp.get_param(cr, uid, 'runbot.workers', default=6))
         running_max = int(icp.get_param(cr, uid, 'runbot.running_max', default=75))
+        host = host_name()
 
         Build = self.pool['runbot.build']
         domain = [('repo_id', 'in', ids)]
+        host_domain = domain + [('host', '=', host)]
+
+        # give back the ports of the builds done while their host was away
+        self.pool['runbot.port'].release_done(cr, uid, host, context=context)
 
         # schedule jobs (transitions testing -> running, kill jobs, ...)
-        build_ids = Build.search(cr, uid, domain + [('state', 'in', ['testing', 'running'])])
+        build_ids = Build.search(cr, uid, host_domain + [('state', 'in', ['testing', 'running'])])
         Build.schedule(cr, uid, build_ids)
 
-        # launch new tests
-        testing = Build.search_count(cr, uid, domain + [('state', '=', 'testing')])
-        pending = Build.search_count(cr, uid, domain + [('state', '=', 'pending')])
-
-        while testing < workers and pending > 0:
-
-            # find sticky pending build if any, otherwise, last pending (by id, not by sequence) will do the job
-            pending_ids = Build.search(cr, uid, domain + [('state', '=', 'pending'), ('branch_id.sticky', '=', True)], limit=1)
-            if not pending_ids:
-                pending_ids = Build.search(cr, uid, domain + [('state', '=', 'pending')], order="sequence", limit=1)
-
-            pending_build = Build.browse(cr, uid, pending_ids[0])
-            pending_build.schedule()
-
-            # compute the number of testing and pending jobs again
-            testing = Build.search_count(cr, uid, domain + [('state', '=', 'testing')])
-            pending = Build.search_count(cr, uid, domain + [('state', '=', 'pending')])
+        # launch new tests: fill the free slots with the head of the queue,
+        # skipping the builds being claimed by other hosts
+        testing = Build.search_count(cr, uid, host_domain + [('state', '=', 'testing')])
+        slots = min(workers - testing, self.admission(cr, uid, context=context))
+        if ids and slots > 0:
+            cr.commit()
+            pending_ids = Build.queue(cr, uid, ids, limit=slots, claim=True, context=context)
+            if pending_ids:
+                Build.write(cr, uid, pending_ids, {'host': host})
+            Build.schedule(cr, uid, pending_ids)
 
         # terminate and reap doomed build
-        build_ids = Build.search(cr, uid, domain + [('state', '=', 'running')])
+        build_ids = Build.search(cr, uid, host_domain + [('state', '=', 'running')])
         # sort builds: the last build of each sticky branch then the rest
         sticky = {}
         non_sticky = []
@@ -340,6 +922,39 @@ class runbot_repo(osv.osv):
         Build.terminate(cr, uid, build_ids[running_max:])
         Build.reap(cr, uid, build_ids)
 
+        self.pool['runbot.host'].register(cr, uid, host, workers, context=context)
+
+    def admission(self, cr, uid, context=None):
+        """Return how many builds this host can start now given its load and
+        its available memory"""
+        icp = self.pool['ir.config_parameter']
+        max_load = float(icp.get_param(cr, uid, 'runbot.max_load', default=1.5))
+        min_free_memory = int(icp.get_param(cr, uid, 'runbot.min_free_memory', default=1024))
+        slots = sys.maxint
+        if max_load:
+            load = host_load()
+            if load >= max_load:
+                _logger.debug('admission: load %.2f per cpu over %.2f', load, max_load)
+                return 0
+        memory = host_memory()
+        if min_free_memory and memory is not None:
+            free = memory - min_free_memory
+            if free <= 0:
+                _logger.debug('admission: %sMB available, %sMB reserved', memory, min_free_memory)
+                return 0
+            # expect a new build to use as much as the recent test jobs of this host
+            cr.execute("""
+                SELECT avg(max_rss) FROM (
+                    SELECT max_rss FROM runbot_build_job
+                     WHERE host = %s AND name = 'job_20_test_all' AND stop IS NOT NULL
+                  ORDER BY id DESC LIMIT 20
+                ) AS recent
+            """, (host_name(),))
+            usage = cr.fetchone()[0]
+            if usage:
+                slots = int(free / (float(usage) / 1024))
+        return slots
+
     def reload_nginx(self, cr, uid, context=None):
         settings = {}
         settings['port'] = openerp.tools.config['xmlrpc_port']
@@ -347,7 +962,7 @@ class runbot_repo(osv.osv):
         settings['nginx_dir'] = nginx_dir
         ids = self.search(cr, uid, [('nginx','=',True)], order='id')
         if ids:
-            build_ids = self.pool['runbot.build'].search(cr, uid, [('repo_id','in',ids), ('state','=','running')])
+            build_ids = self.pool['runbot.build'].search(cr, uid, [('repo_id','in',ids), ('state','=','running'), ('host', '=', host_name())])
             settings['builds'] = self.pool['runbot.build'].browse(cr, uid, build_ids)
 
             nginx_config = self.pool['ir.ui.view'].render(cr, uid, "runbot.nginx_config", settings)
@@ -361,17 +976,52 @@ class runbot_repo(osv.osv):
                 _logger.debug('start nginx')
                 run(['/usr/sbin/nginx', '-p', nginx_dir, '-c', 'nginx.conf'])
 
+    def update_pulls(self, cr, uid, ids, context=None):
+        """Synchronize the open pull requests of the repositories having a token"""
+        Pull = self.pool['runbot.pull']
+        for repo in self.browse(cr, uid, ids, context=context):
+            if not repo.token:
+                continue
+            url = self.github_url(cr, uid, repo, '/repos/:owner/:repo/pulls?state=open&per_page=100', context=context)
+            if not url:
+                continue
+            try:
+                pulls = list(github_client(repo.id, repo.token).pages(url))
+            except Exception:
+                _logger.exception('repo %s pull requests listing failed', repo.name)
+                continue
+            Pull.sync(cr, uid, repo.id, pulls, close_missing=True, context=context)
+
+    def poll_ids(self, cr, uid, ids, context=None):
+        """Return the repositories to fetch, repositories notified by webhooks
+        are only polled every runbot.hook_poll_interval seconds"""
+        icp = self.pool['ir.config_parameter']
+        interval = int(icp.get_param(cr, uid, 'runbot.hook_poll_interval', default=3600))
+        poll_ids = []
+        for repo in self.browse(cr, uid, ids, context=context):
+            if not repo.hook_time or not repo.fetch_time or dt2time(repo.fetch_time) + interval < time.time():
+                poll_ids.append(repo.id)
+        return poll_ids
+
     def killall(self, cr, uid, ids=None, context=None):
         # kill switch
         Build = self.pool['runbot.build']
-        build_ids = Build.search(cr, uid, [('state', 'not in', ['done', 'pending'])])
+        build_ids = Build.search(cr, uid, [('state', 'not in', ['done', 'pending']), ('host', '=', host_name())])
         Build.terminate(cr, uid, build_ids)
         Build.reap(cr, uid, build_ids)
 
-    def cron(self, cr, uid, ids=None, context=None):
+    def cron(self, cr, uid, ids=None, workers=None, context=None):
         ids = self.search(cr, uid, [('auto', '=', True)])
-        self.update(cr, uid, ids)
-        self.scheduler(cr, uid, ids)
+        poll_ids = self.poll_ids(cr, uid, ids, context=context)
+        self.update(cr, uid, poll_ids)
+        self.update_pulls(cr, uid, poll_ids, context=context)
+        self.scheduler(cr, uid, ids, workers=workers)
+        self.reload_nginx(cr, uid, context=context)
+
+    def cron_jobs(self, cr, uid, workers=None, context=None):
+        """Only schedule the builds, e.g. when one of their jobs exited"""
+        ids = self.search(cr, uid, [('auto', '=', True)])
+        self.scheduler(cr, uid, ids, workers=workers)
         self.reload_nginx(cr, uid, context=context)
 
 class runbot_branch(osv.osv):
@@ -400,6 +1050,8 @@ class runbot_branch(osv.osv):
         'branch_url': fields.function(_get_branch_url, type='char', string='Branch url', readonly=1),
         'sticky': fields.boolean('Sticky', select=1),
         'coverage': fields.boolean('Coverage'),
+        'fail_fast': fields.selection([('on', 'Abort on the first error'), ('off', 'Never abort')], 'Fail fast',
+                                      help="Stop the tests on the first error, empty to follow the repository."),
         'state': fields.char('Status'),
     }
 
@@ -449,13 +1101,25 @@ class runbot_build(osv.osv):
         'repo_id': fields.related('branch_id', 'repo_id', type="many2one", relation="runbot.repo", string="Repository", readonly=True, store=True, ondelete='cascade', select=1),
         'name': fields.char('Revno', required=True, select=1),
         'port': fields.integer('Port'),
+        'host': fields.char('Host', select=1),
         'dest': fields.function(_get_dest, type='char', string='Dest', readonly=1, store=True),
         'domain': fields.function(_get_domain, type='char', string='URL'),
         'date': fields.datetime('Commit date'),
         'author': fields.char('Author'),
         'subject': fields.text('Subject'),
         'sequence': fields.integer('Sequence', select=1),
+        'priority': fields.integer('Priority', help="Pending builds with a higher priority are tested first."),
+        'forced': fields.boolean('Forced', help="Rebuild asked by a user, tested even when an earlier build has the same sources."),
         'modules': fields.char("Modules to Install"),
+        'shards': fields.integer('Test shards', help="Number of databases tested in parallel by the last job_20_test_all."),
+        'processes': fields.integer('Test processes', help="Number of server processes of the last job_20_test_all, each one loads its modules and shuts down."),
+        # float rather than an int4 overflowing past 2 GiB of log
+        'log_offset': fields.float('Log offset', help="Size of the job_20_test_all log already scanned."),
+        'log_errors': fields.integer('Errors'),
+        'log_warnings': fields.integer('Warnings'),
+        'log_tests': fields.integer('Tests run'),
+        'log_loaded': fields.integer('Modules loaded', help="Number of test processes done loading their modules."),
+        'log_shutdown': fields.integer('Shutdowns', help="Number of test processes shut down."),
         'result': fields.char('Result'), # ok, ko, warn, skipped, killed
         'pid': fields.integer('Pid'),
         'state': fields.char('Status'), # pending, testing, running, done, duplicate
@@ -465,11 +1129,16 @@ class runbot_build(osv.osv):
         'job_time': fields.function(_get_time, type='integer', string='Job time'),
         'job_age': fields.function(_get_age, type='integer', string='Job age'),
         'duplicate_id': fields.many2one('runbot.build', 'Corresponding Build'),
+        'server_tree': fields.char('Server tree', help="Tree sha of the sources providing the server."),
+        'tree_key': fields.char('Tree key', select=1, help="Hash of the source trees and modules tested, builds with the same key share their result."),
+        'job_ids': fields.one2many('runbot.build.job', 'build_id', 'Jobs'),
     }
 
     _defaults = {
         'state': 'pending',
         'result': '',
+        'priority': 0,
+        'forced': False,
     }
 
     def create(self, cr, uid, values, context=None):
@@ -505,21 +1174,6 @@ class runbot_build(osv.osv):
     def list_jobs(self):
         return sorted(job for job in dir(self) if _re_job.match(job))
 
-    def find_port(self, cr, uid):
-        # currently used port
-        ids = self.search(cr, uid, [('state','not in',['pending','done'])])
-        ports = set(i['port'] for i in self.read(cr, uid, ids, ['port']))
-
-        # starting port
-        icp = self.pool['ir.config_parameter']
-        port = int(icp.get_param(cr, uid, 'runbot.starting_port', default=2000))
-
-        # find next free port
-        while port in ports:
-            port += 2
-
-        return port
-
     def get_closest_branch_name(self, cr, uid, ids, target_repo_id, hint_branches, context=None):
         """Return the name of the closest common branch between both repos
         Find common branch names, get merge-base with the branch name and
@@ -529,32 +1183,34 @@ class runbot_build(osv.osv):
         Pull request branches should not have any association with PR of other
         repos
         """
-        branch_pool = self.pool['runbot.branch']
+        merge_base_pool = self.pool['runbot.merge.base']
+        pull_pool = self.pool['runbot.pull']
         for build in self.browse(cr, uid, ids, context=context):
             branch, repo = build.branch_id, build.repo_id
             name = branch.branch_name
-            # Use github API to find name of branch on which the PR is made
-            if repo.token and name.startswith('refs/pull/'):
-                pull_number = name[len('refs/pull/'):]
-                pr = repo.github('/repos/:owner/:repo/pulls/%s' % pull_number)
-                name = 'refs/heads/' + pr['base']['ref']
+            # Use the pull requests synchronized from github to find the branch on which the PR is made
+            if branch.name.startswith('refs/pull/'):
+                pull_ids = pull_pool.search(cr, uid, [('repo_id', '=', repo.id), ('number', '=', int(branch.branch_name))])
+                if pull_ids:
+                    name = pull_pool.browse(cr, uid, pull_ids[0], context=context).base_ref
             # Find common branch names between repo and target repo
-            branch_ids = branch_pool.search(cr, uid, [('repo_id.id', '=', repo.id)])
-            target_ids = branch_pool.search(cr, uid, [('repo_id.id', '=', target_repo_id)])
-            branch_names = branch_pool.read(cr, uid, branch_ids, ['branch_name', 'name'], context=context)
-            target_names = branch_pool.read(cr, uid, target_ids, ['branch_name', 'name'], context=context)
-            possible_repo_branches = set([i['branch_name'] for i in branch_names if i['name'].startswith('refs/heads')])
-            possible_target_branches = set([i['branch_name'] for i in target_names if i['name'].startswith('refs/heads')])
-            possible_branches = possible_repo_branches.intersection(possible_target_branches)
+            cr.execute("""
+                SELECT branch_name FROM runbot_branch WHERE repo_id = %s AND name LIKE 'refs/heads/%%'
+                INTERSECT
+                SELECT branch_name FROM runbot_branch WHERE repo_id = %s AND name LIKE 'refs/heads/%%'
+            """, (repo.id, target_repo_id))
+            possible_branches = set(row[0] for row in cr.fetchall())
             if name not in possible_branches:
                 hinted_branches = possible_branches.intersection(hint_branches)
                 if hinted_branches:
                     possible_branches = hinted_branches
-                common_refs = {}
-                for target_branch_name in possible_branches:
-                    commit = repo.git(['merge-base', branch.name, target_branch_name]).strip()
-                    cmd = ['log', '-1', '--format=%cd', '--date=iso', commit]
-                    common_refs[target_branch_name] = repo.git(cmd).strip()
+                snapshot = simplejson.loads(repo.ref_snapshot or '{}')
+                targets = dict(
+                    (target_branch_name, snapshot['refs/heads/' + target_branch_name])
+                    for target_branch_name in possible_branches
+                    if 'refs/heads/' + target_branch_name in snapshot
+                )
+                common_refs = merge_base_pool.resolve(cr, uid, repo, build.name, targets, context=context)
                 if common_refs:
                     name = sorted(common_refs.iteritems(), key=operator.itemgetter(1), reverse=True)[0][0]
             return name
@@ -580,7 +1236,7 @@ class runbot_build(osv.osv):
             mkdirs([build.path("logs"), build.server('addons')])
 
             # checkout branch
-            build.branch_id.repo_id.git_export(build.name, build.path())
+            trees = [build.branch_id.repo_id.git_export(build.name, build.path())]
 
             # TODO use git log to get commit message date and author
 
@@ -588,9 +1244,11 @@ class runbot_build(osv.osv):
             if os.path.isdir(build.path('bin/addons')):
                 shutil.move(build.path('bin'), build.server())
 
+            server_tree = trees[0] if os.path.isfile(build.server('__init__.py')) else None
+
             # fallback for addons-only community/project branches
             additional_modules = []
-            if not os.path.isfile(build.server('__init__.py')):
+            if not server_tree:
                 # Use modules to test previously configured in the repository
                 modules_to_test = build.repo_id.modules
                 if not modules_to_test:
@@ -604,7 +1262,9 @@ class runbot_build(osv.osv):
                 for extra_repo in build.repo_id.dependency_ids:
                     closest_name = build.get_closest_branch_name(extra_repo.id, hint_branches)
                     hint_branches.add(closest_name)
-                    extra_repo.git_export(closest_name, build.path())
+                    trees.append(extra_repo.git_export(closest_name, build.path()))
+                    if not server_tree and os.path.isfile(build.server('__init__.py')):
+                        server_tree = trees[-1]
                 # Finally mark all addons to move to openerp/addons
                 additional_modules += [
                     os.path.dirname(module)
@@ -622,20 +1282,199 @@ class runbot_build(osv.osv):
                         'You have duplicate modules in your branches "%s"' % basename
                     )
 
+            # only test the modules impacted by the changes of the branch
+            if build.repo_id.incremental and not build.branch_id.sticky:
+                build.refresh()
+                # the modules the build would test otherwise, as in cmd()
+                modules = build.modules or build.all_modules()
+                impacted = build.impacted_modules([m.strip() for m in modules.split(',') if m.strip()])
+                if impacted is not None:
+                    build._log('checkout', 'Testing the modules impacted by the branch: %s' % (', '.join(impacted) or 'none'))
+                    build.write({'modules': ','.join(impacted) or 'base'})
+
+            # builds of the same sources and modules have the same result
+            build.refresh()
+            key = '\n'.join(trees + [build.modules or ''])
+            build.write({'tree_key': hashlib.sha1(key).hexdigest(), 'server_tree': server_tree})
+
+    def target_sha(self, cr, uid, ids, context=None):
+        """Return the head of the branch targeted by the build in its own
+        repository: the base of its pull request or else the sticky branch
+        it forked from last"""
+        for build in self.browse(cr, uid, ids, context=context):
+            repo = build.repo_id
+            snapshot = simplejson.loads(repo.ref_snapshot or '{}')
+            if build.branch_id.name.startswith('refs/pull/'):
+                pull_ids = self.pool['runbot.pull'].search(cr, uid, [('repo_id', '=', repo.id), ('number', '=', int(build.branch_id.branch_name))])
+                if pull_ids:
+                    base_ref = self.pool['runbot.pull'].browse(cr, uid, pull_ids[0], context=context).base_ref
+                    return snapshot.get('refs/heads/' + base_ref)
+            sticky_ids = self.pool['runbot.branch'].search(cr, uid, [('repo_id', '=', repo.id), ('sticky', '=', True)])
+            targets = dict(
+                (branch.name, snapshot[branch.name])
+                for branch in self.pool['runbot.branch'].browse(cr, uid, sticky_ids, context=context)
+                if branch.name in snapshot
+            )
+            bases = self.pool['runbot.merge.base'].resolve(cr, uid, repo, build.name, targets, context=context)
+            if bases:
+                return targets[sorted(bases.iteritems(), key=operator.itemgetter(1), reverse=True)[0][0]]
+            return None
+
+    def impacted_modules(self, cr, uid, ids, modules, context=None):
+        """Return the modules among modules changed since the merge base of
+        the build with its target branch or depending on a changed module,
+        None when everything must be tested"""
+        for build in self.browse(cr, uid, ids, context=context):
+            target_sha = build.target_sha()
+            if not target_sha:
+                return None
+            base_sha = self.pool['runbot.merge.base'].base_sha(cr, uid, build.repo_id, build.name, target_sha, context=context)
+            if not base_sha:
+                return None
+            try:
+                files = build.repo_id.git(['diff', '--name-only', base_sha, build.name]).splitlines()
+            except subprocess.CalledProcessError:
+                return None
+            changed = set()
+            for path in files:
+                parts = path.split('/')
+                if parts[0] == 'addons' and len(parts) > 2:
+                    changed.add(parts[1])
+                elif parts[0] in ('openerp', 'odoo') and parts[1:2] == ['addons'] and len(parts) > 3:
+                    changed.add(parts[2])
+                elif parts[0] in ('openerp', 'odoo'):
+                    # the server changed
+                    return None
+                elif len(parts) > 1 and os.path.isfile(build.server('addons', parts[0], '__openerp__.py')):
+                    changed.add(parts[0])
+            # expand through the reverse dependencies
+            dependents = {}
+            for manifest in glob.glob(build.server('addons', '*', '__openerp__.py')):
+                module = os.path.basename(os.path.dirname(manifest))
+                for dep in read_manifest(manifest).get('depends', []):
+                    dependents.setdefault(dep, set()).add(module)
+            impacted = set()
+            todo = list(changed)
+            while todo:
+                module = todo.pop()
+                if module not in impacted:
+                    impacted.add(module)
+                    todo.extend(dependents.get(module, ()))
+            return sorted(impacted.intersection(modules))
+
+    def scan_log(self, cr, uid, ids, context=None):
+        """Update the counters of the builds with the lines added to their
+        job_20_test_all log since the last scan, and their result as it goes.
+        The builds failing fast are aborted on their first error."""
+        for build in self.browse(cr, uid, ids, context=context):
+            log_offset = int(build.log_offset or 0)
+            offset, counts, excerpt = scan_log(build.path('logs', 'job_20_test_all.txt'), log_offset)
+            if offset == log_offset:
+                continue
+            first_error = excerpt and not build.log_errors
+            values = dict((name, (build[name] or 0) + n) for name, n in counts.iteritems())
+            values['log_offset'] = offset
+            if values['log_errors']:
+                values['result'] = 'ko'
+            elif values['log_warnings']:
+                values['result'] = 'warn'
+            build.write(values)
+            if first_error and build.state == 'testing' and build.fail_fast():
+                build.abort(excerpt)
+
+    def fail_fast(self, cr, uid, ids, context=None):
+        """Return whether the build is aborted on its first test error, as set
+        on its branch or else on its repository"""
+        for build in self.browse(cr, uid, ids, context=context):
+            if build.branch_id.fail_fast:
+                return build.branch_id.fail_fast == 'on'
+            return build.repo_id.fail_fast
+
+    def abort(self, cr, uid, ids, excerpt, context=None):
+        """Stop testing the builds, they failed"""
+        for build in self.browse(cr, uid, ids, context=context):
+            build._log('fail_fast', 'Aborted on the first error:\n%s' % excerpt)
+            build.logger('killing %s', build.pid)
+            try:
+                os.killpg(build.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            build.write({'state': 'done', 'result': 'ko', 'job': False, 'job_end': now()})
+            self.pool['runbot.port'].release(cr, uid, [build.id], context=context)
+            # unlike terminate, keep the logs of the failure
+            self.pool['runbot.trash'].discard(cr, uid, build, keep_logs=True, context=context)
+            build.github_status()
+            cr.commit()
+
+    def reuse_result(self, cr, uid, ids, context=None):
+        """Mark the builds whose tree key matches an earlier ok or warn result
+        as its duplicates, return the ids of the builds marked. Forced builds
+        are always tested, a failure may come from the host and not the sources."""
+        reused_ids = []
+        for build in self.browse(cr, uid, ids, context=context):
+            if not build.tree_key or build.forced:
+                continue
+            domain = [
+                ('tree_key', '=', build.tree_key),
+                ('id', '!=', build.id),
+                ('state', 'in', ['running', 'done']),
+                ('result', 'in', ['ok', 'warn']),
+            ]
+            result_ids = self.search(cr, uid, domain, order='id desc', limit=1, context=context)
+            if not result_ids:
+                continue
+            build.logger('same sources as build %s, reusing its result', result_ids[0])
+            build.write({'state': 'duplicate', 'duplicate_id': result_ids[0], 'job': False, 'job_end': now()})
+            self.pool['runbot.port'].release(cr, uid, [build.id], context=context)
+            shutil.rmtree(build.path(), True)
+            build.github_status()
+            reused_ids.append(build.id)
+        return reused_ids
+
     def pg_dropdb(self, cr, uid, dbname):
+        self.pg_dropdbs(cr, uid, [dbname])
+
+    def pg_dropdbs(self, cr, uid, dbnames):
+        """Drop the databases dbnames at once, return the ones dropped or missing"""
+        if not dbnames:
+            return []
         pid_col = 'pid' if cr._cnx.server_version >= 90200 else 'procpid'
-        cr.execute("select pg_terminate_backend(%s) from pg_stat_activity where datname = %%s" % pid_col, (dbname,))
-        time.sleep(1)
-        try:
-            openerp.service.db.exp_drop(dbname)
-        except Exception:
-            pass
+        cr.execute("select pg_terminate_backend(%s) from pg_stat_activity where datname in %%s" % pid_col, (tuple(dbnames),))
+        # wait for the backends to exit rather than a fixed delay
+        for i in range(50):
+            cr.execute("select 1 from pg_stat_activity where datname in %s limit 1", (tuple(dbnames),))
+            if not cr.fetchone():
+                break
+            time.sleep(0.1)
+        dropped = []
+        for dbname in dbnames:
+            try:
+                openerp.service.db.exp_drop(dbname)
+            except Exception:
+                _logger.debug('drop %s failed', dbname)
+                continue
+            dropped.append(dbname)
+        return dropped
 
-    def pg_createdb(self, cr, uid, dbname):
+    def pg_createdb(self, cr, uid, dbname, template=None):
         self.pg_dropdb(cr, uid, dbname)
         _logger.debug("createdb %s",dbname)
+        if template:
+            try:
+                pg_copydb(template, dbname)
+                return
+            except psycopg2.Error:
+                _logger.exception('createdb %s from template %s failed', dbname, template)
         openerp.service.db._create_empty_database(dbname)
 
+    def all_modules(self, cr, uid, ids, context=None):
+        """Return the modules of the server addons tested by default"""
+        for build in self.browse(cr, uid, ids, context=context):
+            l = glob.glob(build.server('addons', '*', '__init__.py'))
+            modules = set(os.path.basename(os.path.dirname(i)) for i in l)
+            modules = modules - set(['auth_ldap', 'document_ftp', 'hw_escpos', 'hw_proxy', 'hw_scanner', 'base_gengo', 'website_gengo'])
+            return ",".join(list(modules))
+
     def cmd(self, cr, uid, ids, context=None):
         """Return a list describing the command to start the build"""
         for build in self.browse(cr, uid, ids, context=context):
@@ -649,13 +1488,7 @@ class runbot_build(osv.osv):
                 server_path = build.path("bin/openerp-server.py")
 
             # modules
-            if build.modules:
-                modules = build.modules
-            else:
-                l = glob.glob(build.server('addons', '*', '__init__.py'))
-                modules = set(os.path.basename(os.path.dirname(i)) for i in l)
-                modules = modules - set(['auth_ldap', 'document_ftp', 'hw_escpos', 'hw_proxy', 'hw_scanner', 'base_gengo', 'website_gengo'])
-                modules = ",".join(list(modules))
+            modules = build.modules or build.all_modules()
 
             # commandline
             cmd = [
@@ -680,26 +1513,53 @@ class runbot_build(osv.osv):
 
         return cmd, modules
 
-    def spawn(self, cmd, lock_path, log_path, cpu_limit=None, shell=False, showstderr=False):
-        def preexec_fn():
-            os.setsid()
-            if cpu_limit:
-                # set soft cpulimit
-                soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
-                r = resource.getrusage(resource.RUSAGE_SELF)
-                cpu_time = r.ru_utime + r.ru_stime
-                resource.setrlimit(resource.RLIMIT_CPU, (cpu_time + cpu_limit, hard))
-            # close parent files
-            os.closerange(3, os.sysconf("SC_OPEN_MAX"))
-            lock(lock_path)
-        out=open(log_path,"w")
-        _logger.debug("spawn: %s stdout: %s", ' '.join(cmd), log_path)
-        if showstderr:
-            stderr = out
-        else:
-            stderr = open(os.devnull, 'w')
-        p=subprocess.Popen(cmd, stdout=out, stderr=stderr, preexec_fn=preexec_fn, shell=shell)
-        return p.pid
+    def cgroup_path(self, cr, uid, dest, job, context=None):
+        """Return the cgroup of a job, None when cgroups are not configured"""
+        root = self.pool['ir.config_parameter'].get_param(cr, uid, 'runbot.cgroup_root')
+        if not root:
+            return None
+        return os.path.join(root, '%s-%s' % (dest, job))
+
+    def job_cgroup(self, cr, uid, build, context=None):
+        """Create the cgroup (v2) of the current job of build with the cpu and
+        memory limits of runbot.job_cpu and runbot.job_memory"""
+        path = self.cgroup_path(cr, uid, build.dest, build.job, context=context)
+        if not path:
+            return None
+        icp = self.pool['ir.config_parameter']
+        cpu = float(icp.get_param(cr, uid, 'runbot.job_cpu', default=0))
+        memory = int(icp.get_param(cr, uid, 'runbot.job_memory', default=0))
+        try:
+            mkdirs([path])
+            if cpu:
+                with open(os.path.join(path, 'cpu.max'), 'w') as f:
+                    f.write('%d 100000' % (cpu * 100000))
+            if memory:
+                with open(os.path.join(path, 'memory.max'), 'w') as f:
+                    f.write('%d' % (memory * 1024 * 1024))
+        except (IOError, OSError):
+            _logger.exception('cgroup %s setup failed', path)
+            return None
+        return path
+
+    def spawn(self, cmd, lock_path, log_path, cpu_limit=None, shell=False, showstderr=False, cgroup=None):
+        path = supervisor_path()
+        if path:
+            request = {
+                'op': 'spawn',
+                'cmd': cmd,
+                'lock_path': lock_path,
+                'log_path': log_path,
+                'cpu_limit': cpu_limit,
+                'shell': shell,
+                'showstderr': showstderr,
+                'cgroup': cgroup,
+            }
+            try:
+                return supervisor_request(path, request)['pid']
+            except (socket.error, RuntimeError, ValueError):
+                _logger.exception('runbot supervisor %s unavailable, spawning locally', path)
+        return spawn_job(cmd, lock_path, log_path, cpu_limit=cpu_limit, shell=shell, showstderr=showstderr, cgroup=cgroup)
 
     def github_status(self, cr, uid, ids, context=None):
         """Notify github of failed/successful builds"""
@@ -726,35 +1586,85 @@ class runbot_build(osv.osv):
                 "description": desc,
                 "context": "continuous-integration/runbot"
             }
-            try:
-                build.repo_id.github('/repos/:owner/:repo/statuses/%s' % build.name, status)
-                _logger.debug("github status %s update to %s", build.name, state)
-            except Exception:
-                _logger.exception("github status error")
+            if build.repo_id.token:
+                self.pool['runbot.github.status'].enqueue(cr, uid, build.repo_id.id, build.name, status, context=context)
+                _logger.debug("github status %s queued as %s", build.name, state)
 
     def job_10_test_base(self, cr, uid, build, lock_path, log_path):
         build._log('test_base', 'Start test base module')
         build.github_status()
         # checkout source
         build.checkout()
+        if build.reuse_result():
+            return None
         # run base test
         self.pg_createdb(cr, uid, "%s-base" % build.dest)
         cmd, mods = build.cmd()
         if grep(build.server("tools/config.py"), "test-enable"):
             cmd.append("--test-enable")
         cmd += ['-d', '%s-base' % build.dest, '-i', 'base', '--stop-after-init', '--log-level=test', '--max-cron-threads=0']
-        return self.spawn(cmd, lock_path, log_path, cpu_limit=300)
+        return self.spawn(cmd, lock_path, log_path, cpu_limit=300, cgroup=self.job_cgroup(cr, uid, build))
+
+    def shard_dbnames(self, cr, uid, ids, context=None):
+        """Return the databases of the test shards of the build, but the
+        first one which is dest-all"""
+        for build in self.browse(cr, uid, ids, context=context):
+            return ["%s-all-%d" % (build.dest, i) for i in range(2, (build.shards or 0) + 1)]
 
     def job_20_test_all(self, cr, uid, build, lock_path, log_path):
         build._log('test_all', 'Start test all modules')
-        self.pg_createdb(cr, uid, "%s-all" % build.dest)
+        # start from a copy of base installed, tested by job_10_test_base
+        template = self.pool['runbot.db.template'].get(cr, uid, build)
+        self.pg_createdb(cr, uid, "%s-all" % build.dest, template=template)
         cmd, mods = build.cmd()
-        if grep(build.server("tools/config.py"), "test-enable"):
-            cmd.append("--test-enable")
-        cmd += ['-d', '%s-all' % build.dest, '-i', mods, '--stop-after-init', '--log-level=test', '--max-cron-threads=0']
-        # reset job_start to an accurate job_20 job_time
-        build.write({'job_start': now()})
-        return self.spawn(cmd, lock_path, log_path, cpu_limit=2100)
+        test_enable = grep(build.server("tools/config.py"), "test-enable")
+        modules = [m.strip() for m in mods.split(',') if m.strip()]
+        shards = []
+        if build.repo_id.test_shards > 1:
+            shards = module_shards(build.server('addons'), modules, build.repo_id.test_shards)
+        if len(shards) < 2:
+            if test_enable:
+                cmd.append("--test-enable")
+            cmd += ['-d', '%s-all' % build.dest, '-i', mods, '--stop-after-init', '--log-level=test', '--max-cron-threads=0']
+            # reset job_start to an accurate job_20 job_time
+            build.write(dict(_log_reset, job_start=now(), shards=1, processes=1))
+            return self.spawn(cmd, lock_path, log_path, cpu_limit=2100, cgroup=self.job_cgroup(cr, uid, build))
+
+        # sharded: each group is tested in its own database and on its own
+        # ports, its dependencies are installed first without tests. The first
+        # shard tests in dest-all then installs the other modules without
+        # tests for job_30_run. All the processes write to the job log.
+        extra = self.pool['runbot.port'].allocate(cr, uid, [build.id], count=len(shards) - 1)[build.id]
+        ports = [build.port] + (extra if isinstance(extra, list) else [extra])
+        def install(dbname, port, modules, test=False):
+            install_cmd = [a if not a.startswith('--xmlrpc-port=') else '--xmlrpc-port=%d' % port for a in cmd]
+            if test and test_enable:
+                install_cmd.append("--test-enable")
+            install_cmd += ['-d', dbname, '-i', ','.join(sorted(modules)), '--stop-after-init', '--log-level=test', '--max-cron-threads=0']
+            return ' '.join(pipes.quote(a) for a in install_cmd)
+        chains = []
+        processes = 0
+        for i, (group, port) in enumerate(zip(shards, ports), 1):
+            if i == 1:
+                dbname = '%s-all' % build.dest
+            else:
+                dbname = '%s-all-%d' % (build.dest, i)
+                self.pg_createdb(cr, uid, dbname, template=template)
+            depends = module_depends(build.server('addons'), group)
+            chain = []
+            # base is installed by the template
+            if depends - set(group) - set(['base']):
+                chain.append(install(dbname, port, depends - set(group) - set(['base'])))
+            chain.append(install(dbname, port, group, test=True))
+            if i == 1 and set(modules) - depends:
+                chain.append(install(dbname, port, set(modules) - depends))
+            chains.append(' && '.join(chain))
+            processes += len(chain)
+            build._log('test_all', 'Shard %d: %s' % (i, ', '.join(group)))
+        script = ' '.join('(%s) & pids="$pids $!";' % chain for chain in chains)
+        script += ' rc=0; for pid in $pids; do wait $pid || rc=1; done; exit $rc'
+        build.write(dict(_log_reset, job_start=now(), shards=len(shards), processes=processes))
+        return self.spawn(['sh', '-c', script], lock_path, log_path, cpu_limit=2100, cgroup=self.job_cgroup(cr, uid, build))
 
     def job_30_run(self, cr, uid, build, lock_path, log_path):
         # adjust job_end to record an accurate job_20 job_time
@@ -764,17 +1674,25 @@ class runbot_build(osv.osv):
         v = {
             'job_end': time.strftime(openerp.tools.DEFAULT_SERVER_DATETIME_FORMAT, log_time),
         }
-        if grep(log_all, ".modules.loading: Modules loaded."):
-            if rfind(log_all, _re_error):
+        # count the end of the log, every test process must have loaded its
+        # modules and shut down
+        build.scan_log()
+        build.refresh()
+        processes = build.processes or 1
+        if build.log_loaded >= processes:
+            if build.log_errors:
                 v['result'] = "ko"
-            elif rfind(log_all, _re_warning):
+            elif build.log_warnings:
                 v['result'] = "warn"
-            elif not grep(build.server("test/common.py"), "post_install") or grep(log_all, "Initiating shutdown."):
+            elif not grep(build.server("test/common.py"), "post_install") or build.log_shutdown >= processes:
                 v['result'] = "ok"
         else:
             v['result'] = "ko"
         build.write(v)
         build.github_status()
+        if build.shards > 1:
+            self.pool['runbot.trash'].discard_databases(cr, uid, build.shard_dbnames())
+            self.pool['runbot.port'].release_extra(cr, uid, [build.id])
 
         # run server
         cmd, mods = build.cmd()
@@ -807,25 +1725,21 @@ class runbot_build(osv.osv):
         #    f.close()
         #cmd=[self.client_web_bin_path]
 
-        return self.spawn(cmd, lock_path, log_path, cpu_limit=None, showstderr=True)
+        return self.spawn(cmd, lock_path, log_path, cpu_limit=None, showstderr=True, cgroup=self.job_cgroup(cr, uid, build))
 
     def force(self, cr, uid, ids, context=None):
         """Force a rebuild"""
+        icp = self.pool['ir.config_parameter']
+        priority = int(icp.get_param(cr, uid, 'runbot.force_priority', default=100))
         for build in self.browse(cr, uid, ids, context=context):
-            domain = [('state', '=', 'pending')]
-            pending_ids = self.search(cr, uid, domain, order='id', limit=1)
-            if len(pending_ids):
-                sequence = pending_ids[0]
-            else:
-                sequence = self.search(cr, uid, [], order='id desc', limit=1)[0]
-
             # Force it now
             if build.state == 'done' and build.result == 'skipped':
-                build.write({'state': 'pending', 'sequence':sequence, 'result': '' })
+                build.write({'state': 'pending', 'priority': priority, 'forced': True, 'result': '' })
             # or duplicate it
             elif build.state in ['running', 'done', 'duplicate']:
                 new_build = {
-                    'sequence': sequence,
+                    'priority': priority,
+                    'forced': True,
                     'branch_id': build.branch_id.id,
                     'name': build.name,
                     'author': build.author,
@@ -834,25 +1748,127 @@ class runbot_build(osv.osv):
                 self.create(cr, 1, new_build, context=context)
             return build.repo_id.id
 
+    def _queue_query(self, cr, uid, repo_ids, claim=False, context=None):
+        """SQL ordering the pending builds of repo_ids with its parameters
+
+        The priority of a build is its own priority, plus runbot.sticky_priority
+        on sticky branches, plus one point every runbot.aging seconds spent in
+        the queue. Each repository gets its share of the workers: the n-th
+        pending build of a repository already testing t builds is ranked
+        (t + n) / weight and its score is its priority minus its rank, so that
+        a repository pushing many builds does not delay the others while the
+        aging still lets the oldest builds through. When claiming, the builds
+        over the quota of their repository are left out.
+        """
+        icp = self.pool['ir.config_parameter']
+        params = {
+            'repo_ids': tuple(repo_ids),
+            'sticky': int(icp.get_param(cr, uid, 'runbot.sticky_priority', default=10)),
+            'aging': max(int(icp.get_param(cr, uid, 'runbot.aging', default=3600)), 1),
+        }
+        query = """
+            WITH usage AS (
+                SELECT repo_id, count(*) AS testing
+                  FROM runbot_build
+                 WHERE state = 'testing'
+              GROUP BY repo_id
+            ), prio AS (
+                SELECT bu.id, bu.repo_id, bu.sequence,
+                       coalesce(bu.priority, 0)
+                         + CASE WHEN br.sticky THEN %(sticky)s ELSE 0 END
+                         + extract(epoch FROM (now() at time zone 'UTC') - bu.create_date) / %(aging)s AS priority
+                  FROM runbot_build bu
+                  JOIN runbot_branch br ON br.id = bu.branch_id
+                 WHERE bu.repo_id IN %(repo_ids)s AND bu.state = 'pending'
+            ), ranked AS (
+                SELECT p.id, p.sequence, p.priority,
+                       coalesce(u.testing, 0) + row_number() OVER (PARTITION BY p.repo_id ORDER BY p.priority DESC, p.sequence) AS rank,
+                       coalesce(r.weight, 1) AS weight, coalesce(r.quota, 0) AS quota
+                  FROM prio p
+                  JOIN runbot_repo r ON r.id = p.repo_id
+             LEFT JOIN usage u ON u.repo_id = p.repo_id
+            )
+            SELECT bu.id
+              FROM runbot_build bu
+              JOIN ranked q ON q.id = bu.id
+        """
+        if claim:
+            query += " WHERE bu.state = 'pending' AND (q.quota <= 0 OR q.rank <= q.quota)"
+        query += " ORDER BY q.priority - q.rank / greatest(q.weight, 0.01) DESC, q.sequence"
+        return query, params
+
+    def queue(self, cr, uid, repo_ids, limit=None, claim=False, context=None):
+        """Return the pending builds of repo_ids in scheduling order, claim
+        locks the returned builds and skips the ones locked by other hosts"""
+        if not repo_ids:
+            return []
+        query, params = self._queue_query(cr, uid, repo_ids, claim=claim, context=context)
+        if limit:
+            query += " LIMIT %(limit)s"
+            params['limit'] = limit
+        if claim:
+            query += " FOR UPDATE OF bu SKIP LOCKED"
+        cr.execute(query, params)
+        return [row[0] for row in cr.fetchall()]
+
+    def queue_info(self, cr, uid, context=None):
+        """Return {build_id: (position, estimated wait in seconds or None)}
+        for the pending builds of the automatic repositories"""
+        repo_ids = self.pool['runbot.repo'].search(cr, uid, [('auto', '=', True)], context=context)
+        pending_ids = self.queue(cr, uid, repo_ids, context=context)
+        if not pending_ids:
+            return {}
+        icp = self.pool['ir.config_parameter']
+        cr.execute("SELECT sum(workers) FROM runbot_host WHERE last_seen > (now() at time zone 'UTC') - interval '1 hour'")
+        workers = cr.fetchone()[0] or int(icp.get_param(cr, uid, 'runbot.workers', default=6))
+        # average testing time of the recent builds
+        cr.execute("""
+            SELECT avg(duration) FROM (
+                SELECT sum(wall_time) AS duration
+                  FROM runbot_build_job
+                 WHERE name != 'job_30_run' AND stop IS NOT NULL
+              GROUP BY build_id
+              ORDER BY build_id DESC
+                 LIMIT 50
+            ) AS recent
+        """)
+        duration = cr.fetchone()[0]
+        result = {}
+        for position, build_id in enumerate(pending_ids, 1):
+            wait = ((position - 1) / workers + 1) * float(duration) if duration else None
+            result[build_id] = (position, wait)
+        return result
+
     def schedule(self, cr, uid, ids, context=None):
         jobs = self.list_jobs()
         icp = self.pool['ir.config_parameter']
         timeout = int(icp.get_param(cr, uid, 'runbot.timeout', default=1800))
 
-        for build in self.browse(cr, uid, ids, context=context):
-            if build.state == 'pending':
-                # allocate port and schedule first job
-                port = self.find_port(cr, uid)
+        builds = self.browse(cr, uid, ids, context=context)
+
+        # allocate ports and schedule the first job of all pending builds at once
+        pending_ids = [build.id for build in builds if build.state == 'pending']
+        if pending_ids:
+            ports = self.pool['runbot.port'].allocate(cr, uid, pending_ids, context=context)
+            for build_id in pending_ids:
                 values = {
-                    'port': port,
+                    'port': ports[build_id],
                     'state': 'testing',
                     'job': jobs[0],
                     'job_start': now(),
                     'job_end': False,
                 }
-                build.write(values)
-                cr.commit()
-            else:
+                self.write(cr, uid, [build_id], values, context=context)
+            cr.commit()
+
+        for build in builds:
+            if build.id not in pending_ids:
+                if build.job == 'job_20_test_all':
+                    build.scan_log()
+                    build.refresh()
+                    if build.state == 'done':
+                        # aborted on its first error
+                        continue
                 # check if current job is finished
                 lock_path = build.path('logs', '%s.lock' % build.job)
                 if locked(lock_path):
@@ -873,6 +1889,7 @@ class runbot_build(osv.osv):
                 elif build.job == jobs[-1]:
                     v['state'] = 'done'
                     v['job'] = ''
+                    self.pool['runbot.port'].release(cr, uid, [build.id], context=context)
                 # testing
                 else:
                     v['job'] = jobs[jobs.index(build.job) + 1]
@@ -885,8 +1902,27 @@ class runbot_build(osv.osv):
                 job_method = getattr(self,build.job)
                 lock_path = build.path('logs', '%s.lock' % build.job)
                 log_path = build.path('logs', '%s.txt' % build.job)
-                pid = job_method(cr, uid, build, lock_path, log_path)
-                build.write({'pid': pid})
+                try:
+                    pid = job_method(cr, uid, build, lock_path, log_path)
+                    build.write({'pid': pid})
+                    if pid:
+                        self.pool['runbot.build.job'].create(cr, uid, {
+                            'build_id': build.id,
+                            'name': build.job,
+                            'host': host_name(),
+                            'pid': pid,
+                            'start': now(),
+                        }, context=context)
+                except Exception, e:
+                    # without a process holding its lock, the build would
+                    # move on to its next job as if this one had run
+                    _logger.exception('%s %s failed to start', build.dest, build.job)
+                    cr.rollback()
+                    build.refresh()
+                    build._log(build.job, 'Failed to start: %s' % e)
+                    build.write({'state': 'done', 'result': 'ko', 'job': False, 'job_end': now()})
+                    self.pool['runbot.port'].release(cr, uid, [build.id], context=context)
+                    build.github_status()
             # needed to prevent losing pids if multiple jobs are started and one them raise an exception
             cr.commit()
 
@@ -904,11 +1940,10 @@ class runbot_build(osv.osv):
             except OSError:
                 pass
             build.write({'state': 'done'})
+            self.pool['runbot.port'].release(cr, uid, [build.id], context=context)
+            # databases and sources are removed in the background
+            self.pool['runbot.trash'].discard(cr, uid, build, context=context)
             cr.commit()
-            self.pg_dropdb(cr, uid, "%s-base" % build.dest)
-            self.pg_dropdb(cr, uid, "%s-all" % build.dest)
-            if os.path.isdir(build.path()):
-                shutil.rmtree(build.path())
 
     def kill(self, cr, uid, ids, context=None):
         for build in self.browse(cr, uid, ids, context=context):
@@ -918,14 +1953,27 @@ class runbot_build(osv.osv):
             build.github_status()
 
     def reap(self, cr, uid, ids):
+        """Collect the exits of the jobs, returns a list of exit_info dicts"""
+        exits = []
+        path = supervisor_path()
+        if path:
+            try:
+                exits = supervisor_request(path, {'op': 'exits'})['exits']
+            except (socket.error, RuntimeError, ValueError):
+                _logger.exception('runbot supervisor %s unavailable', path)
+        # jobs spawned locally, e.g. while the supervisor was down
         while True:
             try:
-                pid, status, rusage = os.wait3(os.WNOHANG)
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
             except OSError:
                 break
             if pid == 0:
                 break
-            _logger.debug('reaping: pid: %s status: %s', pid, status)
+            exits.append(exit_info(pid, status, rusage))
+        for info in exits:
+            _logger.debug('reaping: pid: %s status: %s', info['pid'], info['status'])
+        self.pool['runbot.build.job'].record(cr, uid, exits)
+        return exits
 
     def _log(self, cr, uid, ids, func, message, context=None):
         assert len(ids) == 1
@@ -940,6 +1988,546 @@ class runbot_build(osv.osv):
             'line': '0',
         }, context=context)
 
+class runbot_build_job(osv.osv):
+    _name = "runbot.build.job"
+    _order = 'id'
+
+    def _get_cpu_time(self, cr, uid, ids, field_name, arg, context=None):
+        result = {}
+        for job in self.browse(cr, uid, ids, context=context):
+            result[job.id] = job.user_time + job.system_time
+        return result
+
+    _columns = {
+        'build_id': fields.many2one('runbot.build', 'Build', required=True, ondelete='cascade', select=1),
+        'name': fields.char('Job', required=True),
+        'host': fields.char('Host'),
+        'pid': fields.integer('Pid'),
+        'start': fields.datetime('Start'),
+        'stop': fields.datetime('Stop'),
+        'exit_code': fields.integer('Exit code'), # negative signal number when killed
+        'wall_time': fields.float('Wall time (s)'),
+        'user_time': fields.float('User CPU (s)'),
+        'system_time': fields.float('System CPU (s)'),
+        'cpu_time': fields.function(_get_cpu_time, type='float', string='CPU (s)'),
+        'max_rss': fields.integer('Max RSS (KB)'),
+        'read_blocks': fields.integer('Blocks read'),
+        'write_blocks': fields.integer('Blocks written'),
+    }
+
+    def record(self, cr, uid, exits, context=None):
+        """Store the exit status and resource usage reported by reap on the
+        job matching the pid on this host"""
+        host = host_name()
+        for info in exits:
+            ids = self.search(cr, uid, [('host', '=', host), ('pid', '=', info['pid']), ('stop', '=', False)],
+                              order='id desc', limit=1, context=context)
+            if not ids:
+                continue
+            job = self.browse(cr, uid, ids[0], context=context)
+            status = info['status']
+            if os.WIFSIGNALED(status):
+                exit_code = -os.WTERMSIG(status)
+            else:
+                exit_code = os.WEXITSTATUS(status)
+            start = info.get('start') or dt2time(job.start)
+            job.write({
+                'stop': now(),
+                'exit_code': exit_code,
+                'wall_time': info['end'] - start,
+                'user_time': info['utime'],
+                'system_time': info['stime'],
+                'max_rss': info['maxrss'],
+                'read_blocks': info['inblock'],
+                'write_blocks': info['oublock'],
+            })
+            cgroup = self.pool['runbot.build'].cgroup_path(cr, uid, job.build_id.dest, job.name, context=context)
+            if cgroup and os.path.isdir(cgroup):
+                try:
+                    # kill the processes left behind by the job
+                    with open(os.path.join(cgroup, 'cgroup.kill'), 'w') as f:
+                        f.write('1')
+                    os.rmdir(cgroup)
+                except (IOError, OSError):
+                    _logger.debug('cgroup %s not removed', cgroup)
+
+    def branch_stats(self, cr, uid, branch_id, limit=20, context=None):
+        """Average resource usage of each job over the last builds of a branch"""
+        cr.execute("""
+            SELECT j.name, count(*), avg(j.wall_time), avg(j.user_time + j.system_time),
+                   avg(j.max_rss), max(j.max_rss), avg(j.read_blocks), avg(j.write_blocks)
+              FROM runbot_build_job j
+             WHERE j.stop IS NOT NULL
+               AND j.build_id IN (SELECT id FROM runbot_build WHERE branch_id = %s ORDER BY id DESC LIMIT %s)
+          GROUP BY j.name
+          ORDER BY j.name
+        """, (branch_id, limit))
+        keys = ['name', 'count', 'wall_time', 'cpu_time', 'max_rss', 'peak_rss', 'read_blocks', 'write_blocks']
+        return [dict(zip(keys, row)) for row in cr.fetchall()]
+
+class runbot_db_template(osv.osv):
+    _name = "runbot.db.template"
+    _order = 'last_used desc'
+
+    _columns = {
+        'name': fields.char('Database', required=True),
+        'server_tree': fields.char('Server tree', required=True, select=1),
+        'modules': fields.char('Installed modules', required=True),
+        'last_used': fields.datetime('Last used'),
+    }
+    _sql_constraints = [
+        ('name_uniq', 'unique(name)', 'A template database is registered once.'),
+    ]
+
+    def get(self, cr, uid, build, modules='base', context=None):
+        """Return the template database with modules installed for the server
+        sources of build, None when there is none yet
+
+        A missing template is copied from the base database of build once its
+        job_10_test_base succeeded.
+        """
+        if not build.server_tree:
+            return None
+        domain = [('server_tree', '=', build.server_tree), ('modules', '=', modules)]
+        ids = self.search(cr, uid, domain, limit=1, context=context)
+        if ids:
+            template = self.browse(cr, uid, ids[0], context=context)
+            template.write({'last_used': now()})
+            return template.name
+        if modules != 'base' or rfind(build.path('logs', 'job_10_test_base.txt'), _re_error):
+            return None
+        name = 'runbot-template-%s-%s' % (build.server_tree[:12], hashlib.sha1(modules).hexdigest()[:8])
+        try:
+            pg_copydb('%s-base' % build.dest, name)
+        except psycopg2.Error:
+            _logger.exception('template %s creation failed', name)
+            return None
+        try:
+            with cr.savepoint():
+                self.create(cr, uid, {
+                    'name': name,
+                    'server_tree': build.server_tree,
+                    'modules': modules,
+                    'last_used': now(),
+                }, context=context)
+        except psycopg2.IntegrityError:
+            pass
+        self.gc(cr, uid, context=context)
+        return name
+
+    def gc(self, cr, uid, context=None):
+        """Drop the least recently used templates above runbot.template_count"""
+        icp = self.pool['ir.config_parameter']
+        count = int(icp.get_param(cr, uid, 'runbot.template_count', default=10))
+        ids = self.search(cr, uid, [], offset=count, context=context)
+        for template in self.browse(cr, uid, ids, context=context):
+            _logger.debug('dropping template %s', template.name)
+            self.pool['runbot.build'].pg_dropdb(cr, uid, template.name)
+        self.unlink(cr, uid, ids, context=context)
+
+class runbot_trash(osv.osv):
+    _name = "runbot.trash"
+    _order = 'id'
+
+    _columns = {
+        'name': fields.char('Database or directory', required=True),
+        'type': fields.selection([('database', 'Database'), ('directory', 'Directory')], 'Type', required=True),
+        'host': fields.char('Host', select=1),
+        'attempts': fields.integer('Attempts'),
+    }
+    _defaults = {
+        'attempts': 0,
+    }
+
+    max_attempts = 5
+
+    def discard(self, cr, uid, build, keep_logs=False, context=None):
+        """Queue the databases and the directory of a terminated build for
+        removal, the directory is first moved out of the way in root/trash.
+        With keep_logs, the logs directory of the build is left in place."""
+        self.discard_databases(cr, uid, ["%s-base" % build.dest, "%s-all" % build.dest] + build.shard_dbnames(), context=context)
+        path = build.path()
+        if os.path.isdir(path):
+            trash_dir = os.path.join(self.pool['runbot.repo'].root(cr, uid), 'trash')
+            mkdirs([trash_dir])
+            trash_path = tempfile.mkdtemp(prefix='%s-' % build.dest, dir=trash_dir)
+            try:
+                os.rename(path, os.path.join(trash_path, 'build'))
+            except OSError:
+                _logger.exception('moving %s to the trash failed', path)
+                os.rmdir(trash_path)
+            else:
+                if keep_logs and os.path.isdir(os.path.join(trash_path, 'build', 'logs')):
+                    mkdirs([path])
+                    os.rename(os.path.join(trash_path, 'build', 'logs'), os.path.join(path, 'logs'))
+                path = trash_path
+            self.create(cr, uid, {'name': path, 'type': 'directory', 'host': host_name()}, context=context)
+
+    def discard_databases(self, cr, uid, dbnames, context=None):
+        for dbname in dbnames:
+            self.create(cr, uid, {'name': dbname, 'type': 'database'}, context=context)
+
+    def _claim(self, cr, uid, domain, limit, context=None):
+        """Lock up to limit entries matching domain, skipping the ones locked
+        by another teardown"""
+        ids = self.search(cr, uid, domain, limit=limit, context=context)
+        if not ids:
+            return []
+        cr.execute("SELECT id FROM runbot_trash WHERE id IN %s FOR UPDATE SKIP LOCKED", (tuple(ids),))
+        return self.browse(cr, uid, [row[0] for row in cr.fetchall()], context=context)
+
+    def _failed(self, cr, uid, entries, context=None):
+        for entry in entries:
+            if entry.attempts + 1 >= self.max_attempts:
+                _logger.warning('giving up removing %s', entry.name)
+                entry.unlink()
+            else:
+                entry.write({'attempts': entry.attempts + 1})
+
+    def empty(self, cr, uid, context=None):
+        """Drop the queued databases in one batch and remove the queued
+        directories of this host with runbot.teardown_workers threads"""
+        icp = self.pool['ir.config_parameter']
+        batch = int(icp.get_param(cr, uid, 'runbot.teardown_batch', default=100))
+        workers = int(icp.get_param(cr, uid, 'runbot.teardown_workers', default=4))
+
+        entries = self._claim(cr, uid, [('type', '=', 'database')], batch, context=context)
+        if entries:
+            dropped = set(self.pool['runbot.build'].pg_dropdbs(cr, uid, [e.name for e in entries]))
+            self.unlink(cr, uid, [e.id for e in entries if e.name in dropped], context=context)
+            self._failed(cr, uid, [e for e in entries if e.name not in dropped], context=context)
+            cr.commit()
+
+        entries = self._claim(cr, uid, [('type', '=', 'directory'), ('host', '=', host_name())], batch, context=context)
+        if entries:
+            def remove(path):
+                shutil.rmtree(path, True)
+                return not os.path.exists(path)
+            pool = ThreadPool(max(1, min(workers, len(entries))))
+            try:
+                removed = pool.map(remove, [e.name for e in entries])
+            finally:
+                pool.close()
+            self.unlink(cr, uid, [e.id for e, ok in zip(entries, removed) if ok], context=context)
+            self._failed(cr, uid, [e for e, ok in zip(entries, removed) if not ok], context=context)
+            cr.commit()
+
+class runbot_port(osv.osv):
+    _name = "runbot.port"
+    _order = 'host, port'
+
+    _columns = {
+        'host': fields.char('Host', required=True, select=1),
+        'port': fields.integer('Port', required=True, help="A build uses this port and the next one."),
+        'build_id': fields.many2one('runbot.build', 'Build', ondelete='set null', select=1),
+        'unavailable_date': fields.datetime('Unavailable since', help="The port was in use by another process."),
+    }
+    _sql_constraints = [
+        ('host_port_uniq', 'unique(host, port)', 'A port is reserved once per host.'),
+    ]
+
+    def _take(self, cr, uid, host, build_id, starting_port, context=None):
+        """Reserve the lowest free port of host for build_id"""
+        cr.execute("""
+            UPDATE runbot_port SET build_id = %s, unavailable_date = NULL
+             WHERE id = (
+                SELECT id FROM runbot_port
+                 WHERE host = %s AND port >= %s AND build_id IS NULL
+                   AND (unavailable_date IS NULL OR unavailable_date < (now() at time zone 'UTC') - interval '1 hour')
+              ORDER BY port
+                 LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+             )
+         RETURNING port
+        """, (build_id, host, starting_port))
+        row = cr.fetchone()
+        return row and row[0]
+
+    def _extend(self, cr, uid, host, build_id, starting_port, context=None):
+        """Add a port after the last one of host reserved for build_id, None
+        when another scheduler added it first"""
+        cr.execute("SELECT max(port) FROM runbot_port WHERE host = %s", (host,))
+        last = cr.fetchone()[0]
+        port = max(last + 2, starting_port) if last else starting_port
+        try:
+            with cr.savepoint():
+                self.create(cr, uid, {'host': host, 'port': port, 'build_id': build_id}, context=context)
+        except psycopg2.IntegrityError:
+            return None
+        return port
+
+    def _reserve(self, cr, uid, host, build_id, starting_port, context=None):
+        """Reserve a bindable pair of ports on host for build_id"""
+        while True:
+            port = self._take(cr, uid, host, build_id, starting_port, context=context)
+            if not port:
+                port = self._extend(cr, uid, host, build_id, starting_port, context=context)
+                if not port:
+                    continue
+            if port_free(port) and port_free(port + 1):
+                return port
+            _logger.debug('port %s is used by another process', port)
+            cr.execute("""
+                UPDATE runbot_port SET build_id = NULL, unavailable_date = (now() at time zone 'UTC')
+                 WHERE host = %s AND port = %s
+            """, (host, port))
+
+    def allocate(self, cr, uid, build_ids, count=1, context=None):
+        """Reserve count pairs of ports on this host for each build, returns
+        {build_id: port} or {build_id: [ports]} when count is above 1"""
+        icp = self.pool['ir.config_parameter']
+        starting_port = int(icp.get_param(cr, uid, 'runbot.starting_port', default=2000))
+        host = host_name()
+        result = {}
+        for build_id in build_ids:
+            ports = [self._reserve(cr, uid, host, build_id, starting_port, context=context) for i in range(count)]
+            result[build_id] = ports if count > 1 else ports[0]
+        return result
+
+    def release(self, cr, uid, build_ids, context=None):
+        if build_ids:
+            cr.execute("UPDATE runbot_port SET build_id = NULL WHERE build_id IN %s", (tuple(build_ids),))
+
+    def release_extra(self, cr, uid, build_ids, context=None):
+        """Give back the ports of the builds but their main port, e.g. the
+        ports of their test shards"""
+        if build_ids:
+            cr.execute("""
+                UPDATE runbot_port p SET build_id = NULL
+                  FROM runbot_build bu
+                 WHERE bu.id = p.build_id AND p.build_id IN %s AND p.port != bu.port
+            """, (tuple(build_ids),))
+
+    def release_done(self, cr, uid, host, context=None):
+        cr.execute("""
+            UPDATE runbot_port p SET build_id = NULL
+              FROM runbot_build bu
+             WHERE bu.id = p.build_id AND p.host = %s AND bu.state IN ('done', 'pending')
+        """, (host,))
+
+class runbot_host(osv.osv):
+    _name = "runbot.host"
+    _order = 'name'
+
+    _columns = {
+        'name': fields.char('Host', required=True),
+        'workers': fields.integer('Workers'),
+        'nb_testing': fields.integer('Testing'),
+        'nb_running': fields.integer('Running'),
+        'last_seen': fields.datetime('Last seen'),
+    }
+    _sql_constraints = [
+        ('name_uniq', 'unique(name)', 'A host name is unique.'),
+    ]
+
+    def register(self, cr, uid, name, workers, context=None):
+        """Report the capacity and the load of the host name"""
+        cr.execute("SELECT state, count(*) FROM runbot_build WHERE host = %s AND state IN ('testing', 'running') GROUP BY state", (name,))
+        counts = dict(cr.fetchall())
+        values = {
+            'workers': workers,
+            'nb_testing': counts.get('testing', 0),
+            'nb_running': counts.get('running', 0),
+            'last_seen': now(),
+        }
+        ids = self.search(cr, uid, [('name', '=', name)], context=context)
+        if ids:
+            self.write(cr, uid, ids, values, context=context)
+        else:
+            values['name'] = name
+            self.create(cr, uid, values, context=context)
+
+class runbot_pull(osv.osv):
+    _name = "runbot.pull"
+    _order = 'number desc'
+
+    _columns = {
+        'repo_id': fields.many2one('runbot.repo', 'Repository', required=True, ondelete='cascade', select=1),
+        'number': fields.integer('Number', required=True, select=1),
+        'name': fields.char('Title'),
+        'base_ref': fields.char('Base branch'),
+        'head_sha': fields.char('Head commit'),
+        'state': fields.char('Status'), # open, closed
+    }
+    _sql_constraints = [
+        ('repo_number_uniq', 'unique(repo_id, number)', 'A pull request number is unique per repository.'),
+    ]
+
+    def sync(self, cr, uid, repo_id, pulls, close_missing=False, context=None):
+        """Create or update the pull requests from their github representation
+
+        With close_missing, the pulls are the complete list of open pull
+        requests and the other ones are closed.
+        """
+        cr.execute("SELECT number, id, name, base_ref, head_sha, state FROM runbot_pull WHERE repo_id = %s", (repo_id,))
+        existing = dict((row[0], row[1:]) for row in cr.fetchall())
+        for pull in pulls:
+            values = {
+                'name': pull.get('title'),
+                'base_ref': pull['base']['ref'],
+                'head_sha': pull['head']['sha'],
+                'state': pull['state'],
+            }
+            current = existing.pop(pull['number'], None)
+            if current is None:
+                values.update(repo_id=repo_id, number=pull['number'])
+                self.create(cr, uid, values, context=context)
+            elif current[1:] != (values['name'], values['base_ref'], values['head_sha'], values['state']):
+                self.write(cr, uid, [current[0]], values, context=context)
+        if close_missing:
+            closed_ids = [row[0] for row in existing.itervalues() if row[4] == 'open']
+            if closed_ids:
+                self.write(cr, uid, closed_ids, {'state': 'closed'}, context=context)
+
+class runbot_merge_base(osv.osv):
+    _name = "runbot.merge.base"
+    _order = 'id desc'
+
+    _columns = {
+        'name': fields.char('Commit', required=True, select=1),
+        'target_sha': fields.char('Target branch commit', required=True),
+        'base_sha': fields.char('Merge base', required=True),
+        'base_date': fields.datetime('Merge base date'),
+    }
+    _sql_constraints = [
+        ('name_target_uniq', 'unique(name, target_sha)', 'The merge base of two commits is unique.'),
+    ]
+
+    def base_sha(self, cr, uid, repo, sha, target_sha, context=None):
+        """Return the merge base of sha and target_sha, None without common history"""
+        if not self.resolve(cr, uid, repo, sha, {target_sha: target_sha}, context=context):
+            return None
+        cr.execute("SELECT base_sha FROM runbot_merge_base WHERE name = %s AND target_sha = %s", (sha, target_sha))
+        row = cr.fetchone()
+        return row and row[0]
+
+    def resolve(self, cr, uid, repo, sha, targets, context=None):
+        """Return the date of the merge base of sha with each target
+
+        ``targets`` maps target branch names to their head commit, merge bases
+        are cached by (sha, target commit) and the dates of the cache misses
+        are read in a single git process.
+        """
+        if not targets:
+            return {}
+        cr.execute("SELECT target_sha, base_sha, base_date FROM runbot_merge_base WHERE name = %s AND target_sha IN %s",
+                   (sha, tuple(set(targets.itervalues()))))
+        bases = dict((row[0], (row[1], row[2])) for row in cr.fetchall())
+        missing = {}
+        for target_sha in set(targets.itervalues()) - set(bases):
+            try:
+                missing[target_sha] = repo.git(['merge-base', sha, target_sha]).strip()
+            except subprocess.CalledProcessError:
+                # no common history
+                continue
+        if missing:
+            dates = commit_dates(repo.path, set(missing.itervalues()))
+            for target_sha, base_sha in missing.iteritems():
+                base_date = time.strftime(openerp.tools.DEFAULT_SERVER_DATETIME_FORMAT, time.gmtime(dates.get(base_sha, 0)))
+                try:
+                    # resolved concurrently by another host or process
+                    with cr.savepoint():
+                        self.create(cr, uid, {
+                            'name': sha,
+                            'target_sha': target_sha,
+                            'base_sha': base_sha,
+                            'base_date': base_date,
+                        }, context=context)
+                except psycopg2.IntegrityError:
+                    pass
+                bases[target_sha] = (base_sha, base_date)
+        return dict(
+            (target_branch_name, bases[target_sha][1])
+            for target_branch_name, target_sha in targets.iteritems() if target_sha in bases
+        )
+
+class runbot_github_status(osv.osv):
+    _name = "runbot.github.status"
+    _order = 'id'
+
+    _columns = {
+        'repo_id': fields.many2one('runbot.repo', 'Repository', required=True, ondelete='cascade', select=1),
+        'name': fields.char('Commit', required=True, select=1),
+        'context': fields.char('Context', required=True),
+        'state': fields.char('State', required=True), # pending, success, failure, error
+        'target_url': fields.char('Target url'),
+        'description': fields.char('Description'),
+        'attempts': fields.integer('Attempts'),
+        'next_try': fields.datetime('Next try', select=1),
+        'error': fields.text('Last error'),
+    }
+    _defaults = {
+        'attempts': 0,
+    }
+
+    max_attempts = 8
+
+    def enqueue(self, cr, uid, repo_id, sha, status, context=None):
+        """Queue a github status, replacing the one of the same commit and context not sent yet"""
+        values = {
+            'state': status['state'],
+            'target_url': status['target_url'],
+            'description': status['description'],
+            'attempts': 0,
+            'next_try': now(),
+            'error': False,
+        }
+        domain = [('repo_id', '=', repo_id), ('name', '=', sha), ('context', '=', status['context'])]
+        ids = self.search(cr, uid, domain, context=context)
+        if ids:
+            self.write(cr, uid, ids[:1], values, context=context)
+            self.unlink(cr, uid, ids[1:], context=context)
+        else:
+            values.update(repo_id=repo_id, name=sha, context=status['context'])
+            self.create(cr, uid, values, context=context)
+
+    def send(self, cr, uid, ids=None, context=None):
+        """Send the queued statuses in parallel, sent ones are removed from the queue"""
+        icp = self.pool['ir.config_parameter']
+        workers = int(icp.get_param(cr, uid, 'runbot.status_workers', default=4))
+        domain = [('next_try', '<=', now()), ('attempts', '<', self.max_attempts)]
+        statuses = self.browse(cr, uid, self.search(cr, uid, domain, limit=500, context=context), context=context)
+        if not statuses:
+            return
+
+        repo_obj = self.pool['runbot.repo']
+        requests_args = []
+        for status in statuses:
+            url = repo_obj.github_url(cr, uid, status.repo_id, '/repos/:owner/:repo/statuses/%s' % status.name, context=context)
+            payload = {
+                'state': status.state,
+                'target_url': status.target_url,
+                'description': status.description,
+                'context': status.context,
+            }
+            requests_args.append((status.repo_id.id, status.repo_id.token, url, payload))
+
+        def post(args):
+            repo_id, token, url, payload = args
+            try:
+                github_client(repo_id, token).request('POST', url, payload)
+            except Exception, e:
+                return str(e) or repr(e)
+
+        pool = ThreadPool(max(1, min(workers, len(requests_args))))
+        try:
+            errors = pool.map(post, requests_args)
+        finally:
+            pool.close()
+            pool.join()
+
+        for status, (repo_id, token, url, payload), error in zip(statuses, requests_args, errors):
+            if error is None:
+                # only forget the status if it was not superseded meanwhile
+                cr.execute("DELETE FROM runbot_github_status WHERE id = %s AND state = %s AND description = %s",
+                           (status.id, payload['state'], payload['description']))
+                _logger.debug("github status %s update to %s", status.name, payload['state'])
+            else:
+                attempts = status.attempts + 1
+                next_try = time.strftime(openerp.tools.DEFAULT_SERVER_DATETIME_FORMAT, time.localtime(time.time() + min(30 * 2 ** attempts, 3600)))
+                status.write({'attempts': attempts, 'next_try': next_try, 'error': error})
+                _logger.warning("github status %s error (attempt %s): %s", status.name, attempts, error)
+
 class runbot_event(osv.osv):
     _inherit = 'ir.logging'
     _order = 'id'
@@ -954,6 +2542,22 @@ class runbot_event(osv.osv):
 # Runbot Controller
 #----------------------------------------------------------
 
+def hook_body(environ, start_response):
+    """Keep the raw body of the webhook requests in the wsgi environ
+
+    Github signs the raw body of its payloads, which the request parses and
+    consumes as a form before the controller is called. Returns None so that
+    the next handler serves the request.
+    """
+    if environ.get('REQUEST_METHOD') == 'POST' and environ.get('PATH_INFO', '').startswith('/runbot/hook'):
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        environ['runbot.hook_body'] = body
+        environ['wsgi.input'] = StringIO(body)
+    return None
+
+# before the handler of the http controllers
+openerp.service.wsgi_server.module_handlers.insert(0, hook_body)
+
 class RunbotController(http.Controller):
 
     @http.route(['/runbot', '/runbot/repo/<model("runbot.repo"):repo>'], type='http', auth="public", website=True)
@@ -1035,10 +2639,12 @@ class RunbotController(http.Controller):
             build_ids = flatten(build_by_branch_ids.values())
             build_dict = {build.id: build for build in build_obj.browse(cr, uid, build_ids, context=request.context) }
 
+            queue = build_obj.queue_info(cr, uid, context=request.context)
+
             def branch_info(branch):
                 return {
                     'branch': branch,
-                    'builds': [self.build_info(build_dict[build_id]) for build_id in build_by_branch_ids[branch.id]]
+                    'builds': [self.build_info(build_dict[build_id], queue) for build_id in build_by_branch_ids[branch.id]]
                 }
 
             context.update({
@@ -1052,8 +2658,9 @@ class RunbotController(http.Controller):
 
         return request.render("runbot.repo", context)
 
-    def build_info(self, build):
+    def build_info(self, build, queue=None):
         real_build = build.duplicate_id if build.state == 'duplicate' else build
+        position, wait = (queue or {}).get(build.id, (None, None))
         return {
             'id': build.id,
             'name': build.name,
@@ -1069,6 +2676,11 @@ class RunbotController(http.Controller):
             'domain': real_build.domain,
             'port': real_build.port,
             'subject': build.subject,
+            'log_errors': real_build.log_errors,
+            'log_warnings': real_build.log_warnings,
+            'log_tests': real_build.log_tests,
+            'queue_position': position,
+            'queue_wait': s2human(wait) if wait is not None else None,
         }
 
 
@@ -1097,10 +2709,12 @@ class RunbotController(http.Controller):
 
         context = {
             'repo': build.repo_id,
-            'build': self.build_info(build),
+            'build': self.build_info(build, Build.queue_info(cr, uid, context=context) if build.state == 'pending' else None),
             'br': {'branch': build.branch_id},
             'logs': Logging.browse(cr, uid, logging_ids),
-            'other_builds': other_builds
+            'other_builds': other_builds,
+            'jobs': real_build.job_ids,
+            'job_stats': dict((stats['name'], stats) for stats in registry['runbot.build.job'].branch_stats(cr, uid, build.branch_id.id)),
         }
         #context['type'] = type
         #context['level'] = level
@@ -1152,6 +2766,44 @@ class RunbotController(http.Controller):
                     _logger.exception("github error while adding label %s" % label_name)
         return werkzeug.utils.redirect('/runbot/repo/%s' % build.repo_id.id)
 
+    @http.route(['/runbot/hook', '/runbot/hook/<int:repo_id>'], type='http', auth="public", methods=['POST'])
+    def hook(self, repo_id=None, **post):
+        registry, cr, uid = request.registry, request.cr, 1
+        repo_obj = registry['runbot.repo']
+
+        body = request.httprequest.environ.get('runbot.hook_body', '')
+        payload = simplejson.loads(post.get('payload') or body)
+        event = request.httprequest.headers.get('X-GitHub-Event', 'push')
+
+        if repo_id:
+            repos = repo_obj.browse(cr, uid, [repo_id])
+        else:
+            full_name = payload.get('repository', {}).get('full_name', '')
+            repos = repo_obj.browse(cr, uid, repo_obj.search(cr, uid, []))
+            repos = [repo for repo in repos if full_name and repo.base.lower().endswith('/' + full_name.lower())]
+        if not repos:
+            return request.not_found()
+
+        if event == 'push':
+            refnames = [payload['ref']] if payload.get('ref', '').startswith('refs/heads/') else []
+        elif event == 'pull_request':
+            refnames = ['refs/pull/%s' % payload['number']]
+        else:
+            refnames = []
+
+        signature = request.httprequest.headers.get('X-Hub-Signature', '')
+        for repo in repos:
+            if repo.hook_secret:
+                digest = hmac.new(repo.hook_secret.encode('utf-8'), body, hashlib.sha1).hexdigest()
+                if not hmac.compare_digest('sha1=' + digest, str(signature)):
+                    _logger.warning('repo %s hook with a wrong signature', repo.name)
+                    return werkzeug.wrappers.Response(status=403)
+            if event == 'pull_request':
+                registry['runbot.pull'].sync(cr, uid, repo.id, [payload['pull_request']])
+            if refnames:
+                repo.update_hook(refnames)
+        return 'ok'
+
     @http.route([
         '/runbot/badge/<model("runbot.repo"):repo>/<branch>.svg',
         '/runbot/badge/<any(default,flat):theme>/<model("runbot.repo"):repo>/<branch>.svg',
@@ -1237,7 +2889,6 @@ LABELS = {
 
 # - commit/pull more info
 # - v6 support
-# - host field in build
 # - unlink build to remove ir_logging entires # ondelete=cascade
 # - gc either build or only old ir_logging
 # - if nginx server logfiles via each virtual server or map /runbot/static to root
@@ -0,0 +1,209 @@
+# -*- encoding: utf-8 -*-
+
+import collections
+import errno
+import fcntl
+import logging
+import os
+import resource
+import select
+import simplejson
+import socket
+import subprocess
+import time
+
+import openerp
+
+from worker import ChildWatcher
+
+_logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------
+# Job processes
+#----------------------------------------------------------
+
+def lock(filename):
+    fd = os.open(filename, os.O_CREAT | os.O_RDWR, 0600)
+    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def close_fds(start=3):
+    """Close the inherited file descriptors, listing the open ones instead of
+    walking up to SC_OPEN_MAX"""
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        os.closerange(start, os.sysconf("SC_OPEN_MAX"))
+        return
+    for fd in fds:
+        if fd >= start:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def spawn_job(cmd, lock_path, log_path, cpu_limit=None, shell=False, showstderr=False, cgroup=None):
+    """Start a job in its own session and cgroup, return its pid"""
+    def preexec_fn():
+        os.setsid()
+        if cgroup:
+            # move the job in its cgroup before it execs, run unconfined
+            # rather than not at all when the cgroup is gone
+            try:
+                with open(os.path.join(cgroup, 'cgroup.procs'), 'w') as f:
+                    f.write('0')
+            except IOError:
+                pass
+        if cpu_limit:
+            # set soft cpulimit
+            soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            r = resource.getrusage(resource.RUSAGE_SELF)
+            cpu_time = r.ru_utime + r.ru_stime
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_time + cpu_limit, hard))
+        # close parent files
+        close_fds()
+        lock(lock_path)
+    out = open(log_path, "w")
+    _logger.debug("spawn: %s stdout: %s", ' '.join(cmd), log_path)
+    if showstderr:
+        stderr = out
+    else:
+        stderr = open(os.devnull, 'w')
+    try:
+        p = subprocess.Popen(cmd, stdout=out, stderr=stderr, preexec_fn=preexec_fn, shell=shell)
+    finally:
+        out.close()
+        if stderr is not out:
+            stderr.close()
+    return p.pid
+
+def exit_info(pid, status, rusage, start=None):
+    return {
+        'pid': pid,
+        'status': status,
+        'start': start,
+        'end': time.time(),
+        'utime': rusage.ru_utime,
+        'stime': rusage.ru_stime,
+        'maxrss': rusage.ru_maxrss,
+        'inblock': rusage.ru_inblock,
+        'oublock': rusage.ru_oublock,
+    }
+
+#----------------------------------------------------------
+# Supervisor client
+#----------------------------------------------------------
+
+def supervisor_path():
+    """Socket of the supervisor of this host, None when jobs are spawned locally"""
+    return openerp.tools.config.get('runbot_supervisor') or None
+
+def supervisor_request(path, request, timeout=30):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(path)
+        s.sendall(simplejson.dumps(request) + '\n')
+        data = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        s.close()
+    result = simplejson.loads(''.join(data))
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
+
+#----------------------------------------------------------
+# Runbot supervisor
+#----------------------------------------------------------
+
+class Supervisor(object):
+    """Own the job processes of a host and keep their exit status and
+    resource usage until the scheduler collects them"""
+
+    def __init__(self, path, max_exits=10000):
+        self.path = path
+        self.jobs = {}
+        self.exits = collections.deque(maxlen=max_exits)
+
+    def listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        flags = fcntl.fcntl(server.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(server.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        server.bind(self.path)
+        os.chmod(self.path, 0600)
+        server.listen(16)
+        return server
+
+    def reap(self):
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                break
+            if pid == 0:
+                break
+            _logger.debug('reaping: pid: %s status: %s', pid, status)
+            self.exits.append(exit_info(pid, status, rusage, self.jobs.pop(pid, None)))
+
+    def dispatch(self, request):
+        op = request.get('op')
+        if op == 'spawn':
+            pid = spawn_job(request['cmd'], request['lock_path'], request['log_path'],
+                            cpu_limit=request.get('cpu_limit'), shell=request.get('shell', False),
+                            showstderr=request.get('showstderr', False), cgroup=request.get('cgroup'))
+            self.jobs[pid] = time.time()
+            return {'pid': pid}
+        elif op == 'exits':
+            exits = list(self.exits)
+            self.exits.clear()
+            return {'exits': exits}
+        elif op == 'status':
+            return {'pid': os.getpid(), 'jobs': self.jobs.keys(), 'exits': len(self.exits)}
+        return {'error': 'unknown operation %r' % op}
+
+    def handle(self, conn):
+        conn.settimeout(5)
+        try:
+            data = ''
+            while not data.endswith('\n'):
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                result = self.dispatch(simplejson.loads(data))
+            except Exception, e:
+                _logger.exception('runbot supervisor request failed')
+                result = {'error': str(e)}
+            conn.sendall(simplejson.dumps(result))
+        except socket.error:
+            _logger.exception('runbot supervisor connection failed')
+        finally:
+            conn.close()
+
+    def serve(self):
+        watcher = ChildWatcher()
+        server = self.listen()
+        _logger.info('runbot supervisor listening on %s', self.path)
+        while True:
+            try:
+                readable = select.select([server, watcher.rfd], [], [], 60)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = [watcher.rfd]
+            if watcher.rfd in readable:
+                watcher.wait(0)
+            # collect the exits before answering, a request may be waiting for them
+            self.reap()
+            if server in readable:
+                conn = server.accept()[0]
+                self.handle(conn)
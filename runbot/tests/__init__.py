@@ -0,0 +1,4 @@
+import test_github
+import test_hook
+import test_queue
+import test_scan_log
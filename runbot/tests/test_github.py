@@ -0,0 +1,85 @@
+# -*- encoding: utf-8 -*-
+
+import BaseHTTPServer
+import simplejson
+import threading
+import time
+
+import unittest2
+
+from openerp.addons.runbot.runbot import GithubClient, GithubRateLimited
+
+PULLS = [{'number': 1, 'title': 'Test pull request'}]
+
+
+class GithubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Github API stand-in serving PULLS with an ETag and rate limit headers"""
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == '"pulls-1"':
+            self.respond(304)
+        else:
+            self.respond(200, PULLS, {'ETag': '"pulls-1"'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.server.requests.append(('POST', self.path, simplejson.loads(self.rfile.read(length))))
+        self.respond(201, {'state': 'success'})
+
+    def respond(self, status, result=None, headers=None):
+        body = simplejson.dumps(result) if result is not None else ''
+        self.send_response(status)
+        self.send_header('X-RateLimit-Remaining', str(self.server.remaining))
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestGithubClient(unittest2.TestCase):
+    """GithubClient against a local http server"""
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), GithubHandler)
+        self.server.requests = []
+        self.server.remaining = 5000
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/repos/odoo/odoo' % self.server.server_address[1]
+        self.client = GithubClient('token')
+
+    def test_etag_cache(self):
+        self.assertEqual(self.client.request('GET', self.url + '/pulls'), PULLS)
+        # revalidated with the ETag, the not modified response is served from the cache
+        self.assertEqual(self.client.request('GET', self.url + '/pulls'), PULLS)
+        self.assertEqual([r[2] for r in self.server.requests], [None, '"pulls-1"'])
+        stats = self.client.stats()
+        self.assertEqual((stats['calls'], stats['cached'], stats['remaining']), (2, 1, 5000))
+        self.assertGreater(stats['latency'], 0)
+
+    def test_rate_limit_reserve(self):
+        self.server.remaining = GithubClient.reserve - 1
+        self.client.request('GET', self.url + '/pulls')
+        # below the reserve, reads are refused without calling github
+        with self.assertRaises(GithubRateLimited):
+            self.client.request('GET', self.url + '/pulls')
+        self.assertEqual(len(self.server.requests), 1)
+        # statuses are still sent until the quota is exhausted
+        self.server.remaining = 0
+        self.assertEqual(self.client.request('POST', self.url + '/statuses/abc', {'state': 'success'}), {'state': 'success'})
+        with self.assertRaises(GithubRateLimited):
+            self.client.request('POST', self.url + '/statuses/abc', {'state': 'success'})
+        self.assertEqual([r[0] for r in self.server.requests], ['GET', 'POST'])
+        stats = self.client.stats()
+        self.assertEqual((stats['calls'], stats['cached'], stats['remaining']), (2, 0, 0))
@@ -0,0 +1,116 @@
+# -*- encoding: utf-8 -*-
+
+import hashlib
+import hmac
+import os
+import shutil
+import simplejson
+import subprocess
+import tempfile
+import urllib
+import urllib2
+
+from openerp.tests import common
+
+SECRET = 'runbot-secret'
+
+@common.at_install(False)
+@common.post_install(True)
+class TestHook(common.HttpCase):
+    """Post github webhook payloads to /runbot/hook for a repository cloned
+    from a local bare repository"""
+
+    def setUp(self):
+        super(TestHook, self).setUp()
+        self.tmp = tempfile.mkdtemp(prefix='runbot-test-')
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.registry('ir.config_parameter').set_param(self.cr, self.uid, 'runbot.root', os.path.join(self.tmp, 'root'))
+
+        # upstream repository with a master branch, commits are made in work
+        self.upstream = os.path.join(self.tmp, 'upstream.git')
+        self.work = os.path.join(self.tmp, 'work')
+        subprocess.check_output(['git', 'init', '--bare', self.upstream])
+        subprocess.check_output(['git', 'init', self.work])
+        self.master = self.push('refs/heads/master')
+
+        self.Branch = self.registry('runbot.branch')
+        self.Build = self.registry('runbot.build')
+        self.repo_id = self.registry('runbot.repo').create(self.cr, self.uid, {
+            'name': self.upstream,
+            'hook_secret': SECRET,
+        })
+
+    def git(self, *cmd):
+        cmd = ['git', '-C', self.work, '-c', 'user.name=runbot', '-c', 'user.email=runbot@example.com'] + list(cmd)
+        return subprocess.check_output(cmd).strip()
+
+    def push(self, ref):
+        """Commit in work and push the commit to ref upstream, return its sha"""
+        self.git('commit', '--allow-empty', '-m', 'commit for %s' % ref)
+        self.git('push', self.upstream, '+HEAD:%s' % ref)
+        return self.git('rev-parse', 'HEAD')
+
+    def hook(self, event, payload, secret=SECRET):
+        """Post payload as github does, return the http status"""
+        body = urllib.urlencode({'payload': simplejson.dumps(payload)})
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'X-GitHub-Event': event,
+            'X-Hub-Signature': 'sha1=' + hmac.new(secret, body, hashlib.sha1).hexdigest(),
+        }
+        url = 'http://%s:%s/runbot/hook/%d' % (common.HOST, common.PORT, self.repo_id)
+        try:
+            return self.opener.open(urllib2.Request(url, body, headers), timeout=60).getcode()
+        except urllib2.HTTPError, e:
+            return e.code
+
+    def branch(self, name):
+        branch_ids = self.Branch.search(self.cr, self.uid, [('repo_id', '=', self.repo_id), ('name', '=', name)])
+        return branch_ids and self.Branch.browse(self.cr, self.uid, branch_ids[0])
+
+    def builds(self, name):
+        build_ids = self.Build.search(self.cr, self.uid, [('repo_id', '=', self.repo_id), ('branch_id.name', '=', name)])
+        return [build.name for build in self.Build.browse(self.cr, self.uid, build_ids)]
+
+    def test_push(self):
+        self.assertEqual(self.hook('push', {'ref': 'refs/heads/master', 'after': self.master}), 200)
+        self.assertTrue(self.branch('refs/heads/master'))
+        self.assertEqual(self.builds('refs/heads/master'), [self.master])
+
+        sha = self.push('refs/heads/master')
+        self.assertEqual(self.hook('push', {'ref': 'refs/heads/master', 'after': sha}), 200)
+        self.assertIn(sha, self.builds('refs/heads/master'))
+
+    def test_pull_request(self):
+        sha = self.push('refs/pull/1/head')
+        payload = {
+            'action': 'opened',
+            'number': 1,
+            'pull_request': {
+                'number': 1,
+                'title': 'Test pull request',
+                'state': 'open',
+                'base': {'ref': 'master'},
+                'head': {'sha': sha},
+            },
+        }
+        self.assertEqual(self.hook('pull_request', payload), 200)
+        self.assertEqual(self.builds('refs/pull/1'), [sha])
+        Pull = self.registry('runbot.pull')
+        pull_ids = Pull.search(self.cr, self.uid, [('repo_id', '=', self.repo_id), ('number', '=', 1)])
+        self.assertEqual(len(pull_ids), 1)
+        pull = Pull.browse(self.cr, self.uid, pull_ids[0])
+        self.assertEqual((pull.base_ref, pull.head_sha, pull.state), ('master', sha, 'open'))
+
+    def test_deleted_ref(self):
+        sha = self.push('refs/heads/feature')
+        self.assertEqual(self.hook('push', {'ref': 'refs/heads/feature', 'after': sha}), 200)
+        self.assertEqual(self.branch('refs/heads/feature').state, False)
+
+        self.git('push', self.upstream, ':refs/heads/feature')
+        self.assertEqual(self.hook('push', {'ref': 'refs/heads/feature', 'after': '0' * 40, 'deleted': True}), 200)
+        self.assertEqual(self.branch('refs/heads/feature').state, 'deleted')
+
+    def test_bad_signature(self):
+        self.assertEqual(self.hook('push', {'ref': 'refs/heads/master', 'after': self.master}, secret='wrong'), 403)
+        self.assertFalse(self.branch('refs/heads/master'))
@@ -0,0 +1,48 @@
+# -*- encoding: utf-8 -*-
+
+from openerp.tests import common
+
+
+class TestQueue(common.TransactionCase):
+    """Order of the pending builds of two repositories sharing the workers"""
+
+    def setUp(self):
+        super(TestQueue, self).setUp()
+        self.Repo = self.registry('runbot.repo')
+        self.Branch = self.registry('runbot.branch')
+        self.Build = self.registry('runbot.build')
+        self.registry('ir.config_parameter').set_param(self.cr, self.uid, 'runbot.aging', 3600)
+        # the testing builds of other repositories do not matter
+        self.cr.execute("UPDATE runbot_build SET state = 'done' WHERE state IN ('pending', 'testing')")
+        self.busy_id = self.Repo.create(self.cr, self.uid, {'name': '/tmp/runbot-test/busy.git'})
+        self.quiet_id = self.Repo.create(self.cr, self.uid, {'name': '/tmp/runbot-test/quiet.git'})
+
+    def builds(self, repo_id, count):
+        branch_id = self.Branch.create(self.cr, self.uid, {'repo_id': repo_id, 'name': 'refs/heads/master'})
+        return [
+            self.Build.create(self.cr, self.uid, {'branch_id': branch_id, 'name': '%040x' % (repo_id * 1000 + i)})
+            for i in range(count)
+        ]
+
+    def queue(self):
+        return self.Build.queue(self.cr, self.uid, [self.busy_id, self.quiet_id])
+
+    def test_fair_share(self):
+        busy = self.builds(self.busy_id, 6)
+        quiet = self.builds(self.quiet_id, 2)
+        # the builds pushed later by the quiet repository do not wait for
+        # the backlog of the busy one
+        self.assertEqual(self.queue(), [busy[0], quiet[0], busy[1], quiet[1]] + busy[2:])
+
+    def test_weight(self):
+        busy = self.builds(self.busy_id, 4)
+        quiet = self.builds(self.quiet_id, 2)
+        self.Repo.write(self.cr, self.uid, [self.quiet_id], {'weight': 2.0})
+        self.assertEqual(self.queue(), [quiet[0], busy[0], quiet[1]] + busy[1:])
+
+    def test_aging(self):
+        busy = self.builds(self.busy_id, 6)
+        quiet = self.builds(self.quiet_id, 2)
+        # waiting for ten hours outweighs the backlog of its repository
+        self.cr.execute("UPDATE runbot_build SET create_date = create_date - interval '10 hours' WHERE id = %s", (busy[-1],))
+        self.assertEqual(self.queue()[0], busy[-1])
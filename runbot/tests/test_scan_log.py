@@ -0,0 +1,47 @@
+# -*- encoding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import unittest2
+
+from openerp.addons.runbot.runbot import scan_log
+
+PREFIX = '2015-01-02 10:00:00,123 42 INFO db '
+LOG = [
+    PREFIX + 'openerp.modules.loading: loading %s' % ', '.join(['module_%d' % i for i in range(20)]),
+    PREFIX + 'openerp.modules.module: openerp.addons.base.tests.test_base running tests.',
+    PREFIX + 'openerp.modules.loading: Modules loaded.',
+]
+
+
+class TestScanLog(unittest2.TestCase):
+    """Counting the lines of a log read in chunks shorter than its lines"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='runbot-test-')
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.path = os.path.join(self.tmp, 'job_20_test_all.txt')
+
+    def write(self, data):
+        with open(self.path, 'a') as f:
+            f.write(data)
+
+    def test_long_lines(self):
+        self.write(''.join(line + '\n' for line in LOG))
+        offset, counts, excerpt = scan_log(self.path, 0, chunk_size=50)
+        self.assertEqual(offset, os.path.getsize(self.path))
+        self.assertEqual((counts['log_tests'], counts['log_loaded'], counts['log_errors']), (1, 1, 0))
+
+    def test_line_being_written(self):
+        self.write(LOG[0] + '\n' + LOG[1][:60])
+        offset, counts, excerpt = scan_log(self.path, 0, chunk_size=50)
+        # the offset stays at the start of the incomplete line
+        self.assertEqual(offset, len(LOG[0]) + 1)
+        self.assertEqual(counts['log_tests'], 0)
+
+        self.write(LOG[1][60:] + '\n' + LOG[2] + '\n')
+        offset, counts, excerpt = scan_log(self.path, offset, chunk_size=50)
+        self.assertEqual(offset, os.path.getsize(self.path))
+        self.assertEqual((counts['log_tests'], counts['log_loaded']), (1, 1))
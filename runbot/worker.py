@@ -0,0 +1,44 @@
+# -*- encoding: utf-8 -*-
+
+import errno
+import fcntl
+import os
+import select
+import signal
+
+#----------------------------------------------------------
+# Child processes
+#----------------------------------------------------------
+
+class ChildWatcher(object):
+    """Wake up on SIGCHLD through a self-pipe"""
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        signal.set_wakeup_fd(self.wfd)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        # restart the system calls interrupted by the signal
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds, return True if a child exited"""
+        try:
+            readable = select.select([self.rfd], [], [], max(0, timeout))[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = [self.rfd]
+        if not readable:
+            return False
+        try:
+            while os.read(self.rfd, 512):
+                pass
+        except OSError, e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+        return True